@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict, Counter, deque
+
+from loguru import logger
+
+from codec import EncodedIoRequest, request_peripherals, clamp_parallelism, request_concurrency
+from dto import PeripheralIoRequestDto, PeripheralIoResponseDto
+
+
+class _Ticket:
+    __slots__ = ('peripherals', 'weight', 'granted', 'queued_at')
+
+    def __init__(self, peripherals: tuple[str, ...], weight: int, queued_at: float):
+        self.peripherals = peripherals
+        self.weight = weight
+        self.granted = False
+        self.queued_at = queued_at
+
+
+class _AdapterState:
+    def __init__(self, capacity: float):
+        self.condition = threading.Condition()
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peripherals: Counter[str] = Counter()
+        # one FIFO per peripheral set, served round-robin
+        self.queues: OrderedDict[tuple[str, ...], deque[_Ticket]] = OrderedDict()
+        self.successes = 0
+
+    @property
+    def limit(self) -> int:
+        return max(1, int(self.capacity))
+
+
+class AdmissionControlClient:
+    """
+    Client-side admission control in front of a `BleCollectorClient`.
+
+    Every adapter has a budget of BLE connections in flight, and every peripheral a cap on concurrent requests.
+    Waiting requests are queued per peripheral and admitted round-robin, so one busy device cannot starve the
+    others. A ticket that has waited longer than `max_wait` seconds holds back every younger one until it fits,
+    so requests spanning many peripherals, like fleet-wide reads, cannot starve behind single-device requests.
+
+    The adapter budget adapts AIMD-style: it halves when a request fails or when too many of the peripherals it
+    talks to return errors (errors of a single peripheral are that device's problem, see `health`), and grows by
+    one after `increase_after` clean requests. Requests are clamped to run at most the current budget of commands
+    at once (see `codec.clamp_parallelism`) and take as much of it as they run.
+    """
+
+    def __init__(
+            self,
+            client,
+            max_in_flight: int = 4,
+            max_per_peripheral: int = 1,
+            min_in_flight: int = 1,
+            error_threshold: float = 0.25,
+            increase_after: int = 8,
+            max_wait: float = 2.0,
+            clock=time.monotonic,
+    ):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.max_per_peripheral = max_per_peripheral
+        self.min_in_flight = min_in_flight
+        self.error_threshold = error_threshold
+        self.increase_after = increase_after
+        self.max_wait = max_wait
+        self.clock = clock
+        self._states: dict[str, _AdapterState] = {}
+        self._lock = threading.Lock()
+
+    def list_adapters(self):
+        return self.client.list_adapters()
+
+    def describe_adapters(self):
+        return self.client.describe_adapters()
+
+    def _state(self, adapter_id: str) -> _AdapterState:
+        with self._lock:
+            state = self._states.get(adapter_id)
+            if state is None:
+                state = self._states[adapter_id] = _AdapterState(self.max_in_flight)
+            return state
+
+    def in_flight_limit(self, adapter_id: str) -> int:
+        return self._state(adapter_id).limit
+
+    def _admissible(self, state: _AdapterState, ticket: _Ticket) -> bool:
+        if state.in_flight and state.in_flight + ticket.weight > state.limit:
+            return False
+        return all(state.peripherals[p] < self.max_per_peripheral for p in ticket.peripherals)
+
+    def _take(self, state: _AdapterState, key: tuple[str, ...]):
+        queue = state.queues[key]
+        ticket = queue.popleft()
+        if queue:
+            state.queues.move_to_end(key)
+        else:
+            del state.queues[key]
+        ticket.granted = True
+        state.in_flight += ticket.weight
+        state.peripherals.update(ticket.peripherals)
+
+    def _grant(self, state: _AdapterState):
+        now = self.clock()
+        aged = sorted(
+            (queue[0].queued_at, key) for key, queue in state.queues.items() if now - queue[0].queued_at > self.max_wait
+        )
+        for _, key in aged:
+            if not self._admissible(state, state.queues[key][0]):
+                # let in-flight requests drain until the oldest waiting ticket fits
+                state.condition.notify_all()
+                return
+            self._take(state, key)
+
+        granted = True
+        while granted and state.queues:
+            granted = False
+            for key in [*state.queues]:
+                if self._admissible(state, state.queues[key][0]):
+                    self._take(state, key)
+                    granted = True
+        state.condition.notify_all()
+
+    def _acquire(self, state: _AdapterState, peripherals: tuple[str, ...], weight: int) -> _Ticket:
+        with state.condition:
+            ticket = _Ticket(peripherals, weight, self.clock())
+            state.queues.setdefault(peripherals, deque()).append(ticket)
+            self._grant(state)
+            while not ticket.granted:
+                state.condition.wait()
+            return ticket
+
+    def _release(self, state: _AdapterState, ticket: _Ticket):
+        with state.condition:
+            state.in_flight -= ticket.weight
+            state.peripherals.subtract(ticket.peripherals)
+            self._grant(state)
+
+    def _observe(self, adapter_id: str, state: _AdapterState, failed: bool):
+        with state.condition:
+            if failed:
+                capacity = max(self.min_in_flight, state.capacity / 2)
+                if int(capacity) != int(state.capacity):
+                    logger.warning(f'[{adapter_id}] Lowering in-flight limit to {int(capacity)}')
+                state.capacity = capacity
+                state.successes = 0
+                return
+
+            state.successes += 1
+            if state.successes >= self.increase_after and state.capacity < self.max_in_flight:
+                state.capacity = min(self.max_in_flight, state.capacity + 1)
+                state.successes = 0
+
+    def _failed(self, io_request: PeripheralIoRequestDto | EncodedIoRequest, response: PeripheralIoResponseDto) -> bool:
+        """
+        Whether the errors in `response` point at the adapter rather than at individual peripherals: more than
+        one peripheral, and more than `error_threshold` of them, got no answer to any command.
+        """
+        if isinstance(io_request, EncodedIoRequest):
+            if len(io_request.peripherals) < 2:
+                return False
+            # commands of encoded batches cannot be told apart by peripheral; fall back to the command error rate
+            total = errors = 0
+            for batch in response.batch_responses:
+                for command_response in batch.command_responses:
+                    total += 1
+                    if command_response is not None and command_response.Error is not None:
+                        errors += 1
+            return total > 0 and errors / total > self.error_threshold
+
+        answered: dict[str, bool] = {}
+        for batch, batch_response in zip(io_request.batches, response.batch_responses):
+            for command, command_response in zip(batch.commands, batch_response.command_responses):
+                peripheral = (command.Write or command.Read).fqcn.peripheral
+                ok = command_response is not None and command_response.Error is None
+                answered[peripheral] = answered.get(peripheral, False) or ok
+        failed = sum(not ok for ok in answered.values())
+        return failed > 1 and failed / len(answered) > self.error_threshold
+
+    def write_read_peripheral_value(self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest):
+        state = self._state(adapter_id)
+        clamped = clamp_parallelism(io_request, state.limit)
+        ticket = self._acquire(state, request_peripherals(io_request), request_concurrency(clamped))
+        try:
+            response = self.client.write_read_peripheral_value(adapter_id, clamped)
+        except Exception:
+            self._observe(adapter_id, state, failed=True)
+            raise
+        finally:
+            self._release(state, ticket)
+
+        self._observe(adapter_id, state, failed=self._failed(io_request, response))
+        return response
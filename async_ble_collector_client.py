@@ -0,0 +1,113 @@
+import asyncio
+import time
+from typing import Optional
+
+import aiohttp
+from loguru import logger
+
+from codec import encode_io_request, decode_io_response
+from dto import *
+from ble_collector_client import endpoint_of
+from error import ApiException
+from metrics import COLLECTOR_REQUEST_SECONDS, COLLECTOR_RETRIES
+from tracing import span
+
+
+# errors that are known to happen before the collector sees the request
+_CONNECT_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+
+def _retryable(method: str, error: Exception) -> bool:
+    # a POST that failed after it was sent may already have run its batch, see `BleCollectorClient`
+    return method == 'GET' or isinstance(error, _CONNECT_ERRORS)
+
+
+class AsyncBleCollectorClient:
+    """
+    asyncio counterpart of `BleCollectorClient` with the same API.
+
+    The aiohttp session is created lazily on first use, so the client can be built outside of a running loop.
+    """
+    address: str
+
+    def __init__(
+            self,
+            address: str = 'http://127.0.0.1:8000',
+            limit: int = 100,
+            limit_per_host: int = 32,
+            connect_timeout: float = 3.05,
+            read_timeout: float = 120,
+            retries: int = 3,
+            backoff_factor: float = 0.2,
+    ) -> None:
+        self.address = address
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _request(self, method: str, path: str, body: Optional[bytes] = None):
+        headers = {'Content-Type': 'application/json'} if body is not None else None
+        endpoint = endpoint_of(path)
+        attempt = 0
+        while True:
+            status = 'error'
+            started_at = time.perf_counter()
+            try:
+                async with self.session.request(method, f'{self.address}{path}', data=body, headers=headers) as result:
+                    status = str(result.status)
+                    if result.status != 200:
+                        raise ApiException(result.status, text=await result.text())
+                    return (await result.json())['data']
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries or not _retryable(method, e):
+                    raise
+                error = e
+            finally:
+                COLLECTOR_REQUEST_SECONDS.labels(endpoint=endpoint, status=status).observe(
+                    time.perf_counter() - started_at
+                )
+
+            delay = self.backoff_factor * (2 ** attempt)
+            attempt += 1
+            COLLECTOR_RETRIES.labels(endpoint=endpoint).inc()
+            logger.warning(f'{method} {path} failed: {error!r}; retry {attempt}/{self.retries} in {delay}s')
+            await asyncio.sleep(delay)
+
+    async def list_adapters(self) -> list[AdapterInfoDto]:
+        json = await self._request('GET', '/ble/adapters')
+        return [*map(AdapterInfoDto.from_dict, json)]
+
+    async def describe_adapters(self):
+        json = await self._request('GET', '/ble/adapters/describe')
+        return [*map(AdapterDto.from_dict, json)]
+
+    async def write_read_peripheral_value(
+            self,
+            adapter_id: str,
+            io_request: PeripheralIoRequestDto
+    ) -> PeripheralIoResponseDto:
+        body = encode_io_request(io_request)
+        with span('collector.io', adapter=adapter_id, batches=len(io_request.batches), request_bytes=len(body)):
+            json = await self._request('POST', f'/ble/adapters/{adapter_id}/io', body)
+            return decode_io_response(json)
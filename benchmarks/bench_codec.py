@@ -0,0 +1,75 @@
+"""
+Compares the `dataclasses_json` + `drop_nulls` path with the hand-specialised codec.
+
+    python -m benchmarks.bench_codec
+"""
+import dataclasses
+import json
+import timeit
+
+from ble_collector_client import drop_nulls
+from ble_timeout_setter_service import BleTimeoutSetter
+from codec import encode_io_request, decode_io_response
+from dto import IoCommand, PeripheralIoRequestDto, PeripheralIoBatchRequestDto, PeripheralIoResponseDto
+
+
+def build_request(peripherals: int):
+    setter = BleTimeoutSetter(client=None, adapter_id='hci0')
+    return setter.build_set_all_timeouts_request(
+        [f'AA:BB:CC:DD:{i >> 8:02X}:{i & 0xFF:02X}' for i in range(peripherals)], 60000
+    )
+
+
+def build_response(request):
+    return {
+        'batch_responses': [
+            {'command_responses': [{'Ok': [0, 1, 2, 3]} if i % 7 else {'Error': {'message': 'timeout'}}
+                                   for i, _ in enumerate(batch.commands)]}
+            for batch in request.batches
+        ]
+    }
+
+
+def legacy_request(request: PeripheralIoRequestDto) -> PeripheralIoRequestDto:
+    """
+    The request with list write values, as the services built it before they switched to bytes, which
+    `dataclasses_json` cannot serialize.
+    """
+    return PeripheralIoRequestDto(batches=[
+        PeripheralIoBatchRequestDto(commands=[
+            command if command.Write is None else IoCommand(
+                Write=dataclasses.replace(command.Write, value=list(command.Write.value))
+            )
+            for command in batch.commands
+        ], parallelism=batch.parallelism)
+        for batch in request.batches
+    ], parallelism=request.parallelism)
+
+
+def reflective_encode(request):
+    data = request.to_dict()
+    drop_nulls(data)
+    return json.dumps(data).encode()
+
+
+def main(number: int = 20):
+    for peripherals in (1, 10, 100, 1000):
+        request = build_request(peripherals)
+        legacy = legacy_request(request)
+        response = build_response(request)
+        assert json.loads(encode_io_request(request)) == json.loads(reflective_encode(legacy))
+        assert decode_io_response(response) == PeripheralIoResponseDto.from_dict(response)
+
+        rows = [
+            ('encode', lambda: reflective_encode(legacy), lambda: encode_io_request(request)),
+            ('decode', lambda: PeripheralIoResponseDto.from_dict(response), lambda: decode_io_response(response)),
+        ]
+        for name, old, new in rows:
+            old_s = min(timeit.repeat(old, number=number, repeat=3)) / number
+            new_s = min(timeit.repeat(new, number=number, repeat=3)) / number
+            print(f'{name} peripherals={peripherals:<5} dataclasses_json={old_s * 1e6:10.1f}us '
+                  f'codec={new_s * 1e6:9.1f}us speedup={old_s / new_s:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares the bit-by-bit SCD4X CRC loop with the table-driven one and the bulk response decoder.
+
+    python -m benchmarks.bench_crc
+"""
+import random
+import timeit
+
+from contrib.sensirion import crc8, unpack_words, pack_word
+
+
+def bitwise_crc8(data, polynomial=0x31):
+    if isinstance(data, int):
+        data = [(data >> 8) & 0xFF, data & 0xFF]
+    result = 0xFF
+    for byte in data:
+        result ^= byte
+        for bit in range(8):
+            if result & 0x80:
+                result <<= 1
+                result ^= polynomial
+            else:
+                result <<= 1
+    return result & 0xFF
+
+
+def chunked_decode(result):
+    data = []
+    for chunk in range(0, len(result), 3):
+        if bitwise_crc8(result[chunk: chunk + 2]) != result[chunk + 2]:
+            raise ValueError("Invalid CRC8 in response.")
+        data.append((result[chunk] << 8) | result[chunk + 1])
+    return data
+
+
+def main(number: int = 2000):
+    rnd = random.Random(0)
+    for word in range(0x10000):
+        assert crc8(word) == bitwise_crc8(word)
+
+    for words in (1, 3, 9, 64):
+        values = [rnd.randrange(0x10000) for _ in range(words)]
+        buf = b''.join(map(pack_word, values))
+        as_list = list(buf)
+        assert unpack_words(as_list) == chunked_decode(as_list) == values
+
+        old_s = min(timeit.repeat(lambda: chunked_decode(as_list), number=number, repeat=3)) / number
+        new_s = min(timeit.repeat(lambda: unpack_words(as_list), number=number, repeat=3)) / number
+        print(f'decode words={words:<3} bitwise={old_s * 1e6:8.2f}us table={new_s * 1e6:7.2f}us '
+              f'speedup={old_s / new_s:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
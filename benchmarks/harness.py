@@ -0,0 +1,104 @@
+import json
+import statistics
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable, Optional
+
+BASELINES_DIR = Path(__file__).parent / 'baselines'
+
+
+@dataclass
+class Result:
+    name: str
+    ops: int
+    ops_per_sec: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+    # tracemalloc peak of a single operation
+    alloc_peak_kib: float
+    http_calls_per_op: Optional[float] = None
+
+    def row(self) -> str:
+        http = '' if self.http_calls_per_op is None else f' http/op={self.http_calls_per_op:7.2f}'
+        return (f'{self.name:<40} {self.ops_per_sec:12.1f} ops/s  p50={self.p50_ms:8.3f}ms '
+                f'p90={self.p90_ms:8.3f}ms p99={self.p99_ms:8.3f}ms alloc={self.alloc_peak_kib:9.1f}KiB{http}')
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[int(q) - 1]
+
+
+def measure(
+        name: str,
+        fn: Callable[[], object],
+        iterations: int,
+        warmup: int = 1,
+        http_calls: Optional[Callable[[], int]] = None,
+) -> Result:
+    """
+    Runs `fn` `iterations` times and reports throughput, latency percentiles, the allocation peak of one call
+    and, when `http_calls` reads a request counter, collector HTTP calls per operation.
+    """
+    for _ in range(warmup):
+        fn()
+
+    calls_before = http_calls() if http_calls is not None else 0
+    latencies = []
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        op_started_at = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - op_started_at)
+    elapsed = time.perf_counter() - started_at
+    calls = (http_calls() - calls_before) / iterations if http_calls is not None else None
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return Result(
+        name=name,
+        ops=iterations,
+        ops_per_sec=iterations / elapsed,
+        p50_ms=_percentile(latencies_ms, 50),
+        p90_ms=_percentile(latencies_ms, 90),
+        p99_ms=_percentile(latencies_ms, 99),
+        max_ms=max(latencies_ms),
+        alloc_peak_kib=peak / 1024,
+        http_calls_per_op=calls,
+    )
+
+
+def save_baseline(name: str, results: list[Result]) -> Path:
+    BASELINES_DIR.mkdir(exist_ok=True)
+    path = BASELINES_DIR / f'{name}.json'
+    path.write_text(json.dumps([asdict(result) for result in results], indent=2))
+    return path
+
+
+def load_baseline(name: str) -> dict[str, Result]:
+    path = BASELINES_DIR / f'{name}.json'
+    return {row['name']: Result(**row) for row in json.loads(path.read_text())}
+
+
+def compare(results: list[Result], baseline: dict[str, Result]):
+    for result in results:
+        base = baseline.get(result.name)
+        if base is None:
+            print(f'{result.name:<40} (no baseline)')
+            continue
+        speed = (result.ops_per_sec / base.ops_per_sec - 1) * 100
+        p50 = (result.p50_ms / base.p50_ms - 1) * 100 if base.p50_ms else 0.0
+        alloc = (result.alloc_peak_kib / base.alloc_peak_kib - 1) * 100 if base.alloc_peak_kib else 0.0
+        print(f'{result.name:<40} ops/s {speed:+7.1f}%  p50 {p50:+7.1f}%  alloc {alloc:+7.1f}%')
@@ -0,0 +1,200 @@
+"""
+End-to-end benchmark suite for the I/O hot paths, run against the local fake collector.
+
+    python -m benchmarks.run                      # run everything
+    python -m benchmarks.run -k timeouts          # only scenarios whose name contains "timeouts"
+    python -m benchmarks.run --save main          # store results as benchmarks/baselines/main.json
+    python -m benchmarks.run --compare main       # print the change against a stored baseline
+    python -m benchmarks.run --profile out.folded # also write span stacks for flamegraph.pl / speedscope
+"""
+import argparse
+import contextlib
+import sys
+
+from loguru import logger
+
+from ble_collector_client import BleCollectorClient, drop_nulls
+from ble_timeout_setter_service import BleTimeoutSetter
+from bme_calibrator_service import Bme280CalibratorService
+from calibration import Bme280CalibrationEngine
+from telemetry import Bme280TelemetryReader
+from benchmarks.bench_codec import legacy_request
+from benchmarks.harness import measure, save_baseline, load_baseline, compare
+from codec import encode_io_request, decode_io_response
+from contrib import scd
+from contrib.fake_collector import FakeCollector, FakeExpander, FakeSCD41, FakeBme280
+from contrib.scd import SCD4XSession
+from dto import PeripheralIoResponseDto
+from expander import Expander
+from tracing import set_tracer, Tracer, FoldedStackExporter
+from util import pack_data_bundle, i2c_msg
+
+SCD41_ADDRESS = 'FA:6F:EC:EE:4B:36'
+
+
+@contextlib.contextmanager
+def fast_scd_cadence(interval: float):
+    previous = scd.PERIODIC_INTERVAL
+    scd.PERIODIC_INTERVAL = interval
+    try:
+        yield
+    finally:
+        scd.PERIODIC_INTERVAL = previous
+
+
+def bme_address(index: int) -> str:
+    return f'C0:00:00:00:{index >> 8:02X}:{index & 0xFF:02X}'
+
+
+def io_payloads(peripherals: int):
+    request = BleTimeoutSetter(None, 'hci0').build_set_all_timeouts_request(
+        [bme_address(i) for i in range(peripherals)], 60000
+    )
+    response = {
+        'batch_responses': [
+            {'command_responses': [{'Ok': [0, 1, 2, 3]} for _ in batch.commands]}
+            for batch in request.batches
+        ]
+    }
+    return request, response
+
+
+def legacy_round_trip(request, response):
+    data = request.to_dict()
+    drop_nulls(data)
+    return data, PeripheralIoResponseDto.from_dict(response)
+
+
+def codec_round_trip(request, response):
+    return encode_io_request(request), decode_io_response(response)
+
+
+def scenarios(collector: FakeCollector, client: BleCollectorClient, quick: bool):
+    scale = 0.1 if quick else 1.0
+
+    def n(count: int) -> int:
+        return max(1, int(count * scale))
+
+    http_calls = lambda: collector.http_calls['io']
+
+    yield 'pack_data_bundle', lambda: measure(
+        'pack_data_bundle',
+        lambda: pack_data_bundle(lock=2, power=True, command=2, address=0x62, size_write=2, size_read=9,
+                                 mosi=bytearray(b'\xec\x05')),
+        n(20000),
+    )
+
+    for size in (1, 100):
+        request, response = io_payloads(size)
+        legacy = legacy_request(request)
+        yield f'dto_round_trip_legacy[{size}]', lambda: measure(
+            f'dto_round_trip_legacy[{size}]', lambda: legacy_round_trip(legacy, response), n(2000 // size + 5)
+        )
+        yield f'dto_round_trip_codec[{size}]', lambda: measure(
+            f'dto_round_trip_codec[{size}]', lambda: codec_round_trip(request, response), n(20000 // size + 5)
+        )
+
+    expander = Expander(client, collector.adapter_id, SCD41_ADDRESS)
+
+    def rdwr():
+        messages = [
+            i2c_msg.write(scd.DEFAULT_I2C_ADDRESS, bytearray(b'\x23\x22')),
+            i2c_msg.read(scd.DEFAULT_I2C_ADDRESS, 3),
+            i2c_msg.write(scd.DEFAULT_I2C_ADDRESS, bytearray(b'\x23\x18')),
+            i2c_msg.read(scd.DEFAULT_I2C_ADDRESS, 3),
+        ]
+        expander.i2c_rdwr(*messages)
+
+    yield 'expander_i2c_rdwr[4 messages]', lambda: measure(
+        'expander_i2c_rdwr[4 messages]', rdwr, n(200), http_calls=http_calls
+    )
+
+    def scd_measure():
+        with fast_scd_cadence(0.05):
+            session = SCD4XSession(expander)
+            return measure('scd4x_measure', session.read, n(40), http_calls=http_calls)
+
+    yield 'scd4x_measure', scd_measure
+
+    for peripherals in (10, 100, 1000):
+        addresses = [bme_address(i) for i in range(peripherals)]
+        setter = BleTimeoutSetter(client, collector.adapter_id)
+        yield f'set_all_timeouts[{peripherals}]', lambda: measure(
+            f'set_all_timeouts[{peripherals}]', lambda: setter.set_all_timeouts(addresses, 60000),
+            max(1, n(200 // peripherals)), http_calls=http_calls,
+        )
+        yield f'sync_all_timeouts[{peripherals}]', lambda: measure(
+            f'sync_all_timeouts[{peripherals}]', lambda: setter.sync_all_timeouts(addresses, 60000),
+            max(1, n(200 // peripherals)), http_calls=http_calls,
+        )
+
+    calibrator = Bme280CalibratorService(client, collector.adapter_id)
+    addresses = [bme_address(i) for i in range(100)]
+    yield 'calibrate[100]', lambda: measure(
+        'calibrate[100]',
+        lambda: calibrator.calibrate_humidity_offset(addresses, 50.0, 101325.0, 21.0),
+        n(20), http_calls=http_calls,
+    )
+
+    telemetry = Bme280TelemetryReader(client)
+    for peripherals in (100, 1000):
+        addresses = [bme_address(i) for i in range(peripherals)]
+        yield f'bme280_telemetry[{peripherals}]', lambda: measure(
+            f'bme280_telemetry[{peripherals}]', lambda: telemetry.poll(collector.adapter_id, addresses),
+            max(1, n(200 // peripherals)), http_calls=http_calls,
+        )
+
+    engine = Bme280CalibrationEngine(client, collector.adapter_id, samples=5, interval=0.0)
+    addresses = [bme_address(i) for i in range(200)]
+    yield 'calibration_engine[200 x 5 samples]', lambda: measure(
+        'calibration_engine[200 x 5 samples]',
+        lambda: engine.calibrate(addresses, 50.0, 101325.0, 21.0),
+        n(10), http_calls=http_calls,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', dest='filter', default='', help='run scenarios whose name contains this')
+    parser.add_argument('--save', metavar='BASELINE', help='store results under benchmarks/baselines')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with a stored baseline')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake collector per-command latency, seconds')
+    parser.add_argument('--quick', action='store_true', help='run a tenth of the iterations')
+    parser.add_argument('--profile', metavar='PATH', help='write folded span stacks for a flame graph')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    collector = FakeCollector(latency=args.latency, seed=0)
+    collector.add_peripheral(FakeExpander(SCD41_ADDRESS, i2c_devices={scd.DEFAULT_I2C_ADDRESS: FakeSCD41()}))
+    for i in range(1000):
+        collector.add_peripheral(FakeBme280(bme_address(i), seed=i))
+
+    folded = None
+    if args.profile:
+        folded = FoldedStackExporter()
+        set_tracer(Tracer(folded))
+
+    results = []
+    with collector, BleCollectorClient(collector.address) as client:
+        for name, run in scenarios(collector, client, args.quick):
+            if args.filter not in name:
+                continue
+            result = run()
+            results.append(result)
+            print(result.row())
+
+    if folded is not None:
+        with open(args.profile, 'w') as stream:
+            folded.dump(stream)
+        print(f'Wrote span profile to {args.profile}')
+    if args.compare:
+        print()
+        compare(results, load_baseline(args.compare))
+    if args.save:
+        print(f'Saved {save_baseline(args.save, results)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,122 @@
+import time
+from typing import Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from codec import encode_io_request, decode_io_response
 from dto import *
 from error import ApiException
+from metrics import COLLECTOR_REQUEST_SECONDS, COLLECTOR_RETRIES
+from tracing import span
+
+
+def endpoint_of(path: str) -> str:
+    """
+    Metric label for a collector path; adapter ids are dropped so the label set stays fixed.
+    """
+    if path.endswith('/io'):
+        return 'io'
+    if path.endswith('/describe'):
+        return 'describe'
+    return 'adapters'
+
+
+class _CountingRetry(Retry):
+    def increment(self, method=None, url=None, *args, **kwargs):
+        retry = super().increment(method, url, *args, **kwargs)
+        # not reached once retries are exhausted
+        COLLECTOR_RETRIES.labels(endpoint=endpoint_of(url or '')).inc()
+        return retry
 
 
 class BleCollectorClient:
     address: str
+    timeout: tuple[float, float]
 
-    def __init__(self, address: str = 'http://127.0.0.1:8000') -> None:
+    def __init__(
+            self,
+            address: str = 'http://127.0.0.1:8000',
+            pool_connections: int = 4,
+            pool_maxsize: int = 32,
+            pool_block: bool = True,
+            connect_timeout: float = 3.05,
+            read_timeout: float = 120,
+            retries: int = 3,
+            backoff_factor: float = 0.2,
+    ) -> None:
+        """
+        :param pool_connections: number of per-host connection pools to keep
+        :param pool_maxsize: max keep-alive connections per host; with pool_block callers wait for a free one
+        :param read_timeout: must cover the longest BLE `timeout_ms` sent through this client
+        :param retries: retries on connection errors, with exponential backoff
+        """
         self.address = address
+        self.timeout = (connect_timeout, read_timeout)
 
-    def list_adapters(self) -> list[AdapterInfoDto]:
-        result = requests.get(f'{self.address}/ble/adapters')
+        # Only a failed connect is known to happen before the collector sees the request, so only those are
+        # retried for POST: after a read timeout or a reset mid-response the batch has already run, and
+        # replaying writes (SwitchBot commands, calibration offsets, I2C commands) is not safe.
+        # Read errors are retried for idempotent methods only (GET). HTTP error statuses are never retried.
+        retry = _CountingRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=0,
+            other=0,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None):
+        headers = {'Content-Type': 'application/json'} if body is not None else None
+        status = 'error'
+        started_at = time.perf_counter()
+        try:
+            result = self.session.request(
+                method, f'{self.address}{path}', data=body, headers=headers, timeout=self.timeout
+            )
+            status = str(result.status_code)
+        finally:
+            COLLECTOR_REQUEST_SECONDS.labels(endpoint=endpoint_of(path), status=status).observe(
+                time.perf_counter() - started_at
+            )
         if result.status_code != 200:
             raise ApiException(result.status_code, text=result.text)
-        json = result.json()['data']
+        return result.json()['data']
+
+    def _get(self, path: str):
+        return self._request('GET', path)
+
+    def _post(self, path: str, body: bytes):
+        return self._request('POST', path, body)
 
+    def list_adapters(self) -> list[AdapterInfoDto]:
+        json = self._get('/ble/adapters')
         return [*map(AdapterInfoDto.from_dict, json)]
 
     def describe_adapters(self):
-        result = requests.get(f'{self.address}/ble/adapters/describe')
-        if result.status_code != 200:
-            raise ApiException(result.status_code, text=result.text)
-
-        json = result.json()['data']
+        json = self._get('/ble/adapters/describe')
         return [*map(AdapterDto.from_dict, json)]
 
     def write_read_peripheral_value(
@@ -31,13 +124,10 @@ class BleCollectorClient:
             adapter_id: str,
             io_request: PeripheralIoRequestDto
     ) -> PeripheralIoResponseDto:
-        data = io_request.to_dict()
-        drop_nulls(data)
-        result = requests.post(f'{self.address}/ble/adapters/{adapter_id}/io', json=data)
-        if result.status_code != 200:
-            raise ApiException(result.status_code, text=result.text)
-        json = result.json()['data']
-        return PeripheralIoResponseDto.from_dict(json)
+        body = encode_io_request(io_request)
+        with span('collector.io', adapter=adapter_id, batches=len(io_request.batches), request_bytes=len(body)):
+            json = self._post(f'/ble/adapters/{adapter_id}/io', body)
+            return decode_io_response(json)
 
 
 def drop_nulls(data):
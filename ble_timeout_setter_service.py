@@ -1,11 +1,16 @@
 import enum
+import threading
+from typing import Optional
 
 import typing_extensions
+from loguru import logger
 
-from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto
+from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto, PeripheralIoResponseDto
 
 if typing_extensions.TYPE_CHECKING:
     from ble_collector_client import BleCollectorClient
+    from async_ble_collector_client import AsyncBleCollectorClient
+    from topology import TopologyCache
 
 
 class ServiceType(enum.Enum):
@@ -38,10 +43,21 @@ TIMEOUT_MAP = {
 class BleTimeoutSetter:
     timeout_ms: int = 5000
 
-    def __init__(self, client: 'BleCollectorClient', adapter_id: str, timeout_ms: int = 5000):
+    def __init__(
+            self, client: 'BleCollectorClient', adapter_id: str, timeout_ms: int = 5000,
+            topology: Optional['TopologyCache'] = None
+    ):
+        """
+        :param topology: when given, characteristics a peripheral does not expose are skipped
+        """
         self.client = client
         self.adapter_id = adapter_id
         self.timeout_ms = timeout_ms
+        self.topology = topology
+        # last value successfully written per (peripheral, service type); guarded by `_lock`, `forget` runs on
+        # the discovery thread
+        self.written: dict[tuple[str, ServiceType], int] = {}
+        self._lock = threading.Lock()
 
     def build_set_timeout_cmd(self, peripheral: str, service: str, characteristic: str, notification_timeout: int):
         return IoCommand.write(
@@ -50,15 +66,33 @@ class BleTimeoutSetter:
                 service=service,
                 characteristic=characteristic
             ),
-            value=[*notification_timeout.to_bytes(4, 'little', signed=False)],
+            value=notification_timeout.to_bytes(4, 'little', signed=False),
             wait_response=True,
             timeout_ms=self.timeout_ms
         )
 
+    def build_get_timeout_cmd(self, peripheral: str, service: str, characteristic: str):
+        return IoCommand.read(
+            fqcn=Fqcn(
+                peripheral=peripheral,
+                service=service,
+                characteristic=characteristic
+            ),
+            wait_notification=False,
+            timeout_ms=self.timeout_ms
+        )
+
+    def _is_exposed(self, peripheral: str, service_type: ServiceType):
+        if self.topology is None:
+            return True
+        return self.topology.has_characteristic(peripheral, *TIMEOUT_MAP[service_type])
+
     def build_notification_timeout_batch(self, peripheral: str, timeout_map: dict[ServiceType, int]):
         commands = []
         for service_type, notification_timeout in timeout_map.items():
             service_uuid, characteristic_uuid = TIMEOUT_MAP[service_type]
+            if not self._is_exposed(peripheral, service_type):
+                continue
             commands.append(
                 self.build_set_timeout_cmd(
                     peripheral,
@@ -69,13 +103,137 @@ class BleTimeoutSetter:
 
         return PeripheralIoBatchRequestDto(commands=commands, parallelism=10)
 
-    def set_all_timeouts(self, peripherals: list[str], notification_timeout_ms: int):
+    def build_set_all_timeouts_request(self, peripherals: list[str], notification_timeout_ms: int):
         timeout_map = dict.fromkeys(ServiceType, notification_timeout_ms)
 
         batches = [
-            self.build_notification_timeout_batch(peripheral, timeout_map)
-            for peripheral in peripherals
+            batch for batch in (
+                self.build_notification_timeout_batch(peripheral, timeout_map)
+                for peripheral in peripherals
+            )
+            if batch.commands
         ]
 
-        request = PeripheralIoRequestDto(batches=batches, parallelism=min(10, len(peripherals)))
+        return PeripheralIoRequestDto(batches=batches, parallelism=min(10, len(batches)))
+
+    def set_all_timeouts(self, peripherals: list[str], notification_timeout_ms: int):
+        request = self.build_set_all_timeouts_request(peripherals, notification_timeout_ms)
         return self.client.write_read_peripheral_value(self.adapter_id, request)
+
+    def build_get_all_timeouts_request(self, peripherals: list[str]):
+        slots = []
+        batches = []
+        for peripheral in peripherals:
+            service_types = [service_type for service_type in ServiceType if self._is_exposed(peripheral, service_type)]
+            if not service_types:
+                continue
+            slots.append((peripheral, service_types))
+            batches.append(PeripheralIoBatchRequestDto(
+                commands=[
+                    self.build_get_timeout_cmd(peripheral, *TIMEOUT_MAP[service_type])
+                    for service_type in service_types
+                ],
+                parallelism=10
+            ))
+
+        return PeripheralIoRequestDto(batches=batches, parallelism=min(10, len(batches))), slots
+
+    def build_timeout_diff_request(
+            self, slots: list[tuple[str, list[ServiceType]]], read_response: PeripheralIoResponseDto,
+            notification_timeout_ms: int
+    ):
+        """
+        Returns a request writing only the timeouts that differ from `notification_timeout_ms`, or None.
+        A failed read falls back to the value last written through this setter.
+        """
+        timeout_map = {}
+        for (peripheral, service_types), batch in zip(slots, read_response.batch_responses):
+            for service_type, response in zip(service_types, batch.command_responses):
+                key = (peripheral, service_type)
+                with self._lock:
+                    written = self.written.get(key)
+                    if response is not None and response.Ok is not None:
+                        current = int.from_bytes(bytes(response.Ok), 'little', signed=False)
+                        if written is not None and current != written:
+                            logger.info(f'[{peripheral}] {service_type.value} timeout was reset to {current}')
+                            self.written.pop(key, None)
+                    else:
+                        current = written
+
+                if current != notification_timeout_ms:
+                    timeout_map.setdefault(peripheral, {})[service_type] = notification_timeout_ms
+
+        if not timeout_map:
+            return None, []
+
+        batches = [
+            self.build_notification_timeout_batch(peripheral, peripheral_timeouts)
+            for peripheral, peripheral_timeouts in timeout_map.items()
+        ]
+        written = [
+            (peripheral, service_type, value)
+            for peripheral, peripheral_timeouts in timeout_map.items()
+            for service_type, value in peripheral_timeouts.items()
+            if self._is_exposed(peripheral, service_type)
+        ]
+        return PeripheralIoRequestDto(batches=batches, parallelism=min(10, len(batches))), written
+
+    def record_writes(self, written: list[tuple[str, ServiceType, int]], write_response: PeripheralIoResponseDto):
+        responses = (
+            response
+            for batch in write_response.batch_responses
+            for response in batch.command_responses
+        )
+        with self._lock:
+            for (peripheral, service_type, value), response in zip(written, responses):
+                if response is not None and response.Error is None:
+                    self.written[(peripheral, service_type)] = value
+                else:
+                    self.written.pop((peripheral, service_type), None)
+
+    def forget(self, peripheral: str) -> bool:
+        """
+        Drops the values written to `peripheral`; returns whether values of other peripherals are left.
+        """
+        with self._lock:
+            for key in [key for key in self.written if key[0] == peripheral]:
+                del self.written[key]
+            return bool(self.written)
+
+    def sync_all_timeouts(self, peripherals: list[str], notification_timeout_ms: int):
+        """
+        Reads every timeout in one request and writes only those that differ. Returns the write response,
+        or None if everything was already up to date.
+        """
+        read_request, slots = self.build_get_all_timeouts_request(peripherals)
+        if not slots:
+            return None
+        read_response = self.client.write_read_peripheral_value(self.adapter_id, read_request)
+
+        request, written = self.build_timeout_diff_request(slots, read_response, notification_timeout_ms)
+        if request is None:
+            return None
+        response = self.client.write_read_peripheral_value(self.adapter_id, request)
+        self.record_writes(written, response)
+        return response
+
+
+class AsyncBleTimeoutSetter(BleTimeoutSetter):
+    client: 'AsyncBleCollectorClient'
+
+    async def set_all_timeouts(self, peripherals: list[str], notification_timeout_ms: int):
+        request = self.build_set_all_timeouts_request(peripherals, notification_timeout_ms)
+        return await self.client.write_read_peripheral_value(self.adapter_id, request)
+
+    async def sync_all_timeouts(self, peripherals: list[str], notification_timeout_ms: int):
+        read_request, slots = self.build_get_all_timeouts_request(peripherals)
+        if not slots:
+            return None
+        read_response = await self.client.write_read_peripheral_value(self.adapter_id, read_request)
+
+        request, written = self.build_timeout_diff_request(slots, read_response, notification_timeout_ms)
+        if request is None:
+            return None
+        response = await self.client.write_read_peripheral_value(self.adapter_id, request)
+        self.record_writes(written, response)
+        return response
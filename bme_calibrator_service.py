@@ -3,12 +3,13 @@ import struct
 import typing_extensions
 from loguru import logger
 
-from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto
+from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto, PeripheralIoResponseDto
 from util import deserialize_humidity, deserialize_pressure, \
     deserialize_temperature, deserialize_float
 
 if typing_extensions.TYPE_CHECKING:
     from ble_collector_client import BleCollectorClient
+    from async_ble_collector_client import AsyncBleCollectorClient
 
 BME280_SERVICE = '5c853275-723b-4754-a329-969d4bc8121e'
 HUMIDITY_CALIBRATION_CH = 'a0e4a2ba-1234-4321-0001-00805f9b34fb'
@@ -28,9 +29,7 @@ class Bme280CalibratorService:
         self.adapter_id = adapter_id
         self.timeout_ms = timeout_ms
 
-    def calibrate_humidity_offset(
-            self, peripherals: list[str],
-            target_humidity: float, target_pressure: float, target_temperature: float):
+    def build_calibration_read_request(self, peripherals: list[str]):
         def create_read_batch(characteristic):
             return PeripheralIoBatchRequestDto(commands=[
                 IoCommand.read(
@@ -45,7 +44,7 @@ class Bme280CalibratorService:
                 for peripheral in peripherals
             ], parallelism=32)
 
-        request = PeripheralIoRequestDto(batches=[
+        return PeripheralIoRequestDto(batches=[
             create_read_batch(HUMIDITY_CH),
             create_read_batch(TEMPERATURE_CH),
             create_read_batch(PRESSURE_CH),
@@ -55,6 +54,9 @@ class Bme280CalibratorService:
             create_read_batch(PRESSURE_CALIBRATION_CH),
         ], parallelism=4)
 
+    def build_calibration_write_request(
+            self, peripherals: list[str], read_response: PeripheralIoResponseDto,
+            target_humidity: float, target_pressure: float, target_temperature: float):
         write_commands = []
 
         def add_write_command(peripheral, ch, value):
@@ -65,7 +67,7 @@ class Bme280CalibratorService:
                         service=BME280_SERVICE,
                         characteristic=ch
                     ),
-                    value=[*value],
+                    value=value,
                     wait_response=True,
                     timeout_ms=self.timeout_ms
                 )
@@ -73,8 +75,7 @@ class Bme280CalibratorService:
 
         responses = [
             responses.command_responses
-            for responses in
-            self.client.write_read_peripheral_value(self.adapter_id, request).batch_responses
+            for responses in read_response.batch_responses
         ]
         for (peripheral, ah, at, ap, ch, ct, cp) in zip(peripherals, *responses):
             current_h = deserialize_humidity(ah.Ok)
@@ -113,6 +114,32 @@ class Bme280CalibratorService:
             add_write_command(peripheral, PRESSURE_CALIBRATION_CH, next_offset_p)
 
         batch_request = PeripheralIoBatchRequestDto(commands=write_commands, parallelism=32)
-        request = PeripheralIoRequestDto(batches=[batch_request], parallelism=4)
+        return PeripheralIoRequestDto(batches=[batch_request], parallelism=4)
+
+    def calibrate_humidity_offset(
+            self, peripherals: list[str],
+            target_humidity: float, target_pressure: float, target_temperature: float):
+        read_response = self.client.write_read_peripheral_value(
+            self.adapter_id, self.build_calibration_read_request(peripherals)
+        )
+        request = self.build_calibration_write_request(
+            peripherals, read_response, target_humidity, target_pressure, target_temperature
+        )
 
         return self.client.write_read_peripheral_value(self.adapter_id, request)
+
+
+class AsyncBme280CalibratorService(Bme280CalibratorService):
+    client: 'AsyncBleCollectorClient'
+
+    async def calibrate_humidity_offset(
+            self, peripherals: list[str],
+            target_humidity: float, target_pressure: float, target_temperature: float):
+        read_response = await self.client.write_read_peripheral_value(
+            self.adapter_id, self.build_calibration_read_request(peripherals)
+        )
+        request = self.build_calibration_write_request(
+            peripherals, read_response, target_humidity, target_pressure, target_temperature
+        )
+
+        return await self.client.write_read_peripheral_value(self.adapter_id, request)
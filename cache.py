@@ -0,0 +1,228 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from bme_calibrator_service import BME280_SERVICE, HUMIDITY_CALIBRATION_CH, TEMPERATURE_CALIBRATION_CH, \
+    PRESSURE_CALIBRATION_CH
+from codec import EncodedIoRequest
+from dto import PeripheralIoRequestDto, PeripheralIoBatchRequestDto, PeripheralIoResponseDto, \
+    PeripheralIoBatchResponseDto, CommandResponse, Fqcn
+from metrics import READ_CACHE_REQUESTS
+
+# characteristics that only change when written through this service: (service, characteristic) -> TTL seconds
+DEFAULT_READ_TTLS = {
+    (BME280_SERVICE, HUMIDITY_CALIBRATION_CH): 3600.0,
+    (BME280_SERVICE, TEMPERATURE_CALIBRATION_CH): 3600.0,
+    (BME280_SERVICE, PRESSURE_CALIBRATION_CH): 3600.0,
+}
+
+
+def fqcn_key(fqcn: Fqcn) -> tuple:
+    return 'fqcn', fqcn.peripheral, fqcn.service, fqcn.characteristic
+
+
+def i2c_key(peripheral: str, address: Optional[int], command: Hashable) -> tuple:
+    """
+    Key of an I2C-level read behind an Expander, e.g. an SCD4X command or a bus scan.
+    """
+    return 'i2c', peripheral, address, command
+
+
+class ReadCache:
+    """
+    Thread-safe LRU cache with a TTL per entry. Keys are tuples of (kind, peripheral, ...), see `fqcn_key`
+    and `i2c_key`.
+    """
+
+    def __init__(self, maxsize: int = 4096, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    READ_CACHE_REQUESTS.labels(kind=key[0], result='hit').inc()
+                    return value
+                del self._entries[key]
+        READ_CACHE_REQUESTS.labels(kind=key[0], result='miss').inc()
+        return default
+
+    def put(self, key: tuple, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_peripheral(self, peripheral: str, kind: Optional[str] = None):
+        with self._lock:
+            for key in [
+                key for key in self._entries
+                if key[1] == peripheral and (kind is None or key[0] == kind)
+            ]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Plan:
+    __slots__ = ('written', 'cacheable', 'hits', 'request', 'sent')
+
+    def __init__(self):
+        self.written: set[tuple] = set()
+        # (batch, command) -> (key, ttl) of reads whose result can be stored
+        self.cacheable: dict[tuple[int, int], tuple[tuple, float]] = {}
+        self.hits: dict[tuple[int, int], CommandResponse] = {}
+        self.request = None
+        # (batch, [commands]) of the original request that were sent, in the order of the sent request
+        self.sent: list[tuple[int, list[int]]] = []
+
+
+class CachingClient:
+    """
+    Serves reads of rarely changing characteristics (`ttls`) from a `ReadCache`, sending only the missing
+    commands to the collector. A write to a characteristic through this client drops its cached value.
+
+    Pre-encoded requests are passed through, dropping the entries of the characteristics they declare in
+    `EncodedIoRequest.writes`. `cache` is shared with the `Expander`s built on top of this client for I2C-level
+    entries.
+    """
+
+    def __init__(self, client, cache: Optional[ReadCache] = None, ttls: Optional[dict[tuple[str, str], float]] = None):
+        self.client = client
+        self.cache = cache if cache is not None else ReadCache()
+        self.ttls = DEFAULT_READ_TTLS if ttls is None else ttls
+
+    def list_adapters(self):
+        return self.client.list_adapters()
+
+    def describe_adapters(self):
+        return self.client.describe_adapters()
+
+    def _plan(self, io_request: PeripheralIoRequestDto) -> _Plan:
+        plan = _Plan()
+        for batch in io_request.batches:
+            for command in batch.commands:
+                if command.Write is not None:
+                    plan.written.add(fqcn_key(command.Write.fqcn))
+        for key in plan.written:
+            self.cache.invalidate(key)
+
+        for batch_index, batch in enumerate(io_request.batches):
+            for command_index, command in enumerate(batch.commands):
+                read = command.Read
+                if read is None or read.wait_notification:
+                    continue
+                ttl = self.ttls.get((read.fqcn.service, read.fqcn.characteristic))
+                key = fqcn_key(read.fqcn)
+                if ttl is None or key in plan.written:
+                    continue
+                value = self.cache.get(key)
+                if value is not None:
+                    plan.hits[(batch_index, command_index)] = CommandResponse(Ok=list(value))
+                else:
+                    plan.cacheable[(batch_index, command_index)] = (key, ttl)
+
+        if not plan.hits:
+            plan.request = io_request
+            plan.sent = [(index, [*range(len(batch.commands))]) for index, batch in enumerate(io_request.batches)]
+            return plan
+
+        batches = []
+        for batch_index, batch in enumerate(io_request.batches):
+            missing = [index for index in range(len(batch.commands)) if (batch_index, index) not in plan.hits]
+            if missing:
+                plan.sent.append((batch_index, missing))
+                batches.append(PeripheralIoBatchRequestDto(
+                    commands=[batch.commands[index] for index in missing], parallelism=batch.parallelism
+                ))
+        if batches:
+            plan.request = PeripheralIoRequestDto(batches=batches, parallelism=io_request.parallelism)
+        return plan
+
+    def _complete(
+            self, io_request: PeripheralIoRequestDto, plan: _Plan, response: Optional[PeripheralIoResponseDto]
+    ) -> PeripheralIoResponseDto:
+        command_responses = [[None] * len(batch.commands) for batch in io_request.batches]
+        for (batch_index, command_index), hit in plan.hits.items():
+            command_responses[batch_index][command_index] = hit
+
+        if response is not None:
+            for (batch_index, indexes), batch_response in zip(plan.sent, response.batch_responses):
+                for command_index, command_response in zip(indexes, batch_response.command_responses):
+                    command_responses[batch_index][command_index] = command_response
+                    cacheable = plan.cacheable.get((batch_index, command_index))
+                    if cacheable is not None and command_response is not None and command_response.Ok is not None:
+                        key, ttl = cacheable
+                        self.cache.put(key, tuple(command_response.Ok), ttl)
+
+        # a concurrent read may have cached a value from before these writes landed
+        for key in plan.written:
+            self.cache.invalidate(key)
+        return PeripheralIoResponseDto([PeripheralIoBatchResponseDto(responses) for responses in command_responses])
+
+    def _invalidate_encoded(self, io_request: EncodedIoRequest):
+        for fqcn in io_request.writes:
+            self.cache.invalidate(fqcn_key(fqcn))
+
+    def write_read_peripheral_value(self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest):
+        if isinstance(io_request, EncodedIoRequest):
+            self._invalidate_encoded(io_request)
+            return self.client.write_read_peripheral_value(adapter_id, io_request)
+
+        plan = self._plan(io_request)
+        if plan.request is io_request:
+            response = self.client.write_read_peripheral_value(adapter_id, io_request)
+            if not plan.cacheable and not plan.written:
+                return response
+            return self._complete(io_request, plan, response)
+        response = None
+        if plan.request is not None:
+            response = self.client.write_read_peripheral_value(adapter_id, plan.request)
+        return self._complete(io_request, plan, response)
+
+
+class AsyncCachingClient(CachingClient):
+    """
+    `CachingClient` over an `AsyncBleCollectorClient`.
+    """
+
+    async def list_adapters(self):
+        return await self.client.list_adapters()
+
+    async def describe_adapters(self):
+        return await self.client.describe_adapters()
+
+    async def write_read_peripheral_value(
+            self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest
+    ):
+        if isinstance(io_request, EncodedIoRequest):
+            self._invalidate_encoded(io_request)
+            return await self.client.write_read_peripheral_value(adapter_id, io_request)
+
+        plan = self._plan(io_request)
+        if plan.request is io_request:
+            response = await self.client.write_read_peripheral_value(adapter_id, io_request)
+            if not plan.cacheable and not plan.written:
+                return response
+            return self._complete(io_request, plan, response)
+        response = None
+        if plan.request is not None:
+            response = await self.client.write_read_peripheral_value(adapter_id, plan.request)
+        return self._complete(io_request, plan, response)
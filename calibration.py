@@ -0,0 +1,301 @@
+"""
+Fleet-wide BME280 calibration from repeated samples.
+
+Every sampling round is one multi-peripheral `/io` request; the rounds are stacked into (samples, peripherals)
+arrays and reduced per device with a robust estimator, so a single noisy reading no longer becomes the
+permanent offset.
+"""
+import enum
+import struct
+import time
+import warnings
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+from bme_calibrator_service import BME280_SERVICE, HUMIDITY_CH, TEMPERATURE_CH, PRESSURE_CH, \
+    HUMIDITY_CALIBRATION_CH, TEMPERATURE_CALIBRATION_CH, PRESSURE_CALIBRATION_CH
+from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto, PeripheralIoResponseDto
+from util import compute_r
+
+
+def _decode_array(values: Sequence[Optional[Sequence[int]]], dtype: str) -> np.ndarray:
+    """
+    Decodes a column of characteristic values into float64 in one pass; missing values (failed reads) become NaN.
+    """
+    out = np.full(len(values), np.nan)
+    present = [index for index, value in enumerate(values) if value is not None]
+    if not present:
+        return out
+    width = np.dtype(dtype).itemsize
+    if all(len(values[index]) == width for index in present):
+        raw = np.array([values[index] for index in present], dtype=np.uint8)
+        out[present] = raw.view(dtype)[:, 0]
+    else:
+        # odd-sized values: decode them one by one like the scalar helpers do
+        for index in present:
+            value = bytes(values[index])
+            if dtype[1] == 'f':
+                out[index] = struct.unpack('<f', value)[0]
+            else:
+                out[index] = int.from_bytes(value, byteorder='little', signed=True)
+    return out
+
+
+def deserialize_temperature_array(values) -> np.ndarray:
+    return _decode_array(values, '<i2') * compute_r(1, 1, -2, 0)
+
+
+def deserialize_pressure_array(values) -> np.ndarray:
+    return _decode_array(values, '<i4') * compute_r(1, 1, -1, 0)
+
+
+def deserialize_humidity_array(values) -> np.ndarray:
+    return _decode_array(values, '<i2') * compute_r(1, 1, -2, 0)
+
+
+def deserialize_float_array(values) -> np.ndarray:
+    return _decode_array(values, '<f4')
+
+
+class Quantity(enum.Enum):
+    HUMIDITY = 'humidity'
+    TEMPERATURE = 'temperature'
+    PRESSURE = 'pressure'
+
+
+SENSOR_CHARACTERISTICS = {
+    Quantity.HUMIDITY: (HUMIDITY_CH, deserialize_humidity_array),
+    Quantity.TEMPERATURE: (TEMPERATURE_CH, deserialize_temperature_array),
+    Quantity.PRESSURE: (PRESSURE_CH, deserialize_pressure_array),
+}
+
+CALIBRATION_CHARACTERISTICS = {
+    Quantity.HUMIDITY: HUMIDITY_CALIBRATION_CH,
+    Quantity.TEMPERATURE: TEMPERATURE_CALIBRATION_CH,
+    Quantity.PRESSURE: PRESSURE_CALIBRATION_CH,
+}
+
+# smallest offset change worth a write: %rH, degrees Celsius, Pa
+DEFAULT_THRESHOLDS = {
+    Quantity.HUMIDITY: 0.5,
+    Quantity.TEMPERATURE: 0.1,
+    Quantity.PRESSURE: 5.0,
+}
+
+
+def nan_trimmed_mean(samples: np.ndarray, proportion: float) -> np.ndarray:
+    """
+    Mean of every column after dropping `proportion` of its valid values from each end; NaNs are ignored.
+    """
+    ordered = np.sort(samples, axis=0)  # NaNs sort last
+    counts = np.count_nonzero(~np.isnan(samples), axis=0)
+    cut = np.floor(counts * proportion).astype(int)
+    rows = np.arange(samples.shape[0])[:, None]
+    keep = (rows >= cut) & (rows < counts - cut)
+    kept = keep.sum(axis=0)
+    total = np.where(keep, ordered, 0.0).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(kept > 0, total / kept, np.nan)
+
+
+@dataclass
+class CalibrationResult:
+    peripherals: list[str]
+    # per quantity, arrays aligned with `peripherals`; NaN where a device had too few valid samples
+    estimates: dict[Quantity, np.ndarray]
+    current_offsets: dict[Quantity, np.ndarray]
+    next_offsets: dict[Quantity, np.ndarray]
+    written: list[tuple[str, Quantity, float]] = field(default_factory=list)
+    response: Optional[PeripheralIoResponseDto] = None
+
+
+class Bme280CalibrationEngine:
+    """
+    :param samples: sampling rounds per run
+    :param interval: seconds between rounds
+    :param estimator: 'median' or 'trimmed_mean'
+    :param trim: proportion cut from each end by the trimmed mean
+    :param min_samples: valid samples a device needs to be calibrated; defaults to half of `samples`
+    :param thresholds: minimal offset change per quantity that is written
+    """
+
+    def __init__(
+            self,
+            client,
+            adapter_id: str,
+            samples: int = 5,
+            interval: float = 2.0,
+            estimator: str = 'median',
+            trim: float = 0.2,
+            min_samples: Optional[int] = None,
+            thresholds: Optional[dict[Quantity, float]] = None,
+            timeout_ms: int = 5000,
+            sleep: Callable[[float], None] = time.sleep,
+    ):
+        if estimator not in ('median', 'trimmed_mean'):
+            raise ValueError(f'Unknown estimator {estimator}')
+        self.client = client
+        self.adapter_id = adapter_id
+        self.samples = samples
+        self.interval = interval
+        self.estimator = estimator
+        self.trim = trim
+        self.min_samples = min_samples if min_samples is not None else max(1, (samples + 1) // 2)
+        self.thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+        self.timeout_ms = timeout_ms
+        self.sleep = sleep
+
+    def _read_batch(self, peripherals: list[str], characteristic: str) -> PeripheralIoBatchRequestDto:
+        return PeripheralIoBatchRequestDto(commands=[
+            IoCommand.read(
+                fqcn=Fqcn(peripheral=peripheral, service=BME280_SERVICE, characteristic=characteristic),
+                wait_notification=False,
+                timeout_ms=self.timeout_ms,
+            )
+            for peripheral in peripherals
+        ], parallelism=32)
+
+    def build_sample_request(
+            self, peripherals: list[str], offset_peripherals: list[str] = ()
+    ) -> PeripheralIoRequestDto:
+        """
+        One batch per sensor characteristic over `peripherals`, followed by one per calibration characteristic
+        over `offset_peripherals` if any.
+        """
+        batches = [self._read_batch(peripherals, characteristic) for characteristic, _ in SENSOR_CHARACTERISTICS.values()]
+        if offset_peripherals:
+            batches += [
+                self._read_batch(offset_peripherals, characteristic)
+                for characteristic in CALIBRATION_CHARACTERISTICS.values()
+            ]
+        return PeripheralIoRequestDto(batches=batches, parallelism=4)
+
+    @staticmethod
+    def _column(response: PeripheralIoResponseDto, index: int) -> list:
+        return [
+            None if command is None or command.Error is not None else command.Ok
+            for command in response.batch_responses[index].command_responses
+        ]
+
+    def decode_samples(self, response: PeripheralIoResponseDto) -> dict[Quantity, np.ndarray]:
+        return {
+            quantity: decode(self._column(response, index))
+            for index, (quantity, (_, decode)) in enumerate(SENSOR_CHARACTERISTICS.items())
+        }
+
+    def decode_offsets(self, response: PeripheralIoResponseDto) -> dict[Quantity, np.ndarray]:
+        first = len(SENSOR_CHARACTERISTICS)
+        return {
+            quantity: deserialize_float_array(self._column(response, first + index))
+            for index, quantity in enumerate(CALIBRATION_CHARACTERISTICS)
+        }
+
+    def collect(self, peripherals: list[str]) -> tuple[dict[Quantity, np.ndarray], dict[Quantity, np.ndarray]]:
+        """
+        Runs the sampling rounds; returns (samples shaped (rounds, peripherals), current offsets) per quantity.
+
+        Current offsets are read in the first round; those that failed are read again in the following ones.
+        """
+        rounds = {quantity: [] for quantity in SENSOR_CHARACTERISTICS}
+        offsets = {quantity: np.full(len(peripherals), np.nan) for quantity in CALIBRATION_CHARACTERISTICS}
+        missing = np.arange(len(peripherals))
+        for index in range(self.samples):
+            if index:
+                self.sleep(self.interval)
+            offset_peripherals = [peripherals[i] for i in missing]
+            response = self.client.write_read_peripheral_value(
+                self.adapter_id, self.build_sample_request(peripherals, offset_peripherals)
+            )
+            for quantity, values in self.decode_samples(response).items():
+                rounds[quantity].append(values)
+            if offset_peripherals:
+                for quantity, values in self.decode_offsets(response).items():
+                    offsets[quantity][missing] = values
+                missing = np.flatnonzero(np.any([np.isnan(values) for values in offsets.values()], axis=0))
+        return {quantity: np.vstack(values) for quantity, values in rounds.items()}, offsets
+
+    def estimate(self, samples: np.ndarray) -> np.ndarray:
+        if self.estimator == 'median':
+            with warnings.catch_warnings():
+                # all-NaN columns are expected for unreachable devices
+                warnings.simplefilter('ignore', RuntimeWarning)
+                estimate = np.nanmedian(samples, axis=0)
+        else:
+            estimate = nan_trimmed_mean(samples, self.trim)
+        valid = np.count_nonzero(~np.isnan(samples), axis=0)
+        return np.where(valid >= self.min_samples, estimate, np.nan)
+
+    def compute(
+            self, peripherals: list[str], samples: dict[Quantity, np.ndarray], offsets: dict[Quantity, np.ndarray],
+            targets: dict[Quantity, float],
+    ) -> CalibrationResult:
+        estimates = {quantity: self.estimate(samples[quantity]) for quantity in targets}
+        next_offsets = {
+            # readings already include the current offset
+            quantity: targets[quantity] - (estimates[quantity] - offsets[quantity])
+            for quantity in targets
+        }
+        return CalibrationResult(
+            peripherals=peripherals,
+            estimates=estimates,
+            current_offsets={quantity: offsets[quantity] for quantity in targets},
+            next_offsets=next_offsets,
+        )
+
+    def build_write_request(self, result: CalibrationResult) -> Optional[PeripheralIoRequestDto]:
+        """
+        Writes only finite offsets that moved by more than the quantity's threshold; fills `result.written`.
+        """
+        commands = []
+        for quantity, next_offsets in result.next_offsets.items():
+            change = np.abs(next_offsets - result.current_offsets[quantity])
+            selected = np.isfinite(next_offsets) & (change > self.thresholds[quantity])
+            indexes = np.flatnonzero(selected)
+            if not len(indexes):
+                continue
+            packed = next_offsets[indexes].astype('<f4').tobytes()
+            characteristic = CALIBRATION_CHARACTERISTICS[quantity]
+            for position, index in enumerate(indexes):
+                peripheral = result.peripherals[index]
+                commands.append(IoCommand.write(
+                    fqcn=Fqcn(peripheral=peripheral, service=BME280_SERVICE, characteristic=characteristic),
+                    value=packed[position * 4:position * 4 + 4],
+                    wait_response=True,
+                    timeout_ms=self.timeout_ms,
+                ))
+                result.written.append((peripheral, quantity, float(next_offsets[index])))
+
+        if not commands:
+            return None
+        return PeripheralIoRequestDto(
+            batches=[PeripheralIoBatchRequestDto(commands=commands, parallelism=32)], parallelism=4
+        )
+
+    def calibrate(
+            self, peripherals: list[str],
+            target_humidity: float, target_pressure: float, target_temperature: float,
+    ) -> CalibrationResult:
+        targets = {
+            Quantity.HUMIDITY: target_humidity,
+            Quantity.TEMPERATURE: target_temperature,
+            Quantity.PRESSURE: target_pressure,
+        }
+        samples, offsets = self.collect(peripherals)
+        result = self.compute(peripherals, samples, offsets, targets)
+
+        unknown = np.any([np.isnan(offsets) for offsets in result.next_offsets.values()], axis=0)
+        if unknown.any():
+            skipped = [peripherals[index] for index in np.flatnonzero(unknown)]
+            logger.warning(f'Too few valid samples or no current offsets, not calibrating {skipped}')
+
+        request = self.build_write_request(result)
+        if request is None:
+            logger.info(f'Calibration offsets of {len(peripherals)} peripherals are within thresholds')
+            return result
+
+        result.response = self.client.write_read_peripheral_value(self.adapter_id, request)
+        logger.info(f'Wrote {len(result.written)} calibration offsets for {len(peripherals)} peripherals')
+        return result
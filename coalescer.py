@@ -0,0 +1,170 @@
+import threading
+from collections import Counter
+from typing import Optional
+
+from codec import EncodedIoRequest, encode_batch, request_peripherals, request_writes, request_batch_peripherals
+from dto import PeripheralIoRequestDto, PeripheralIoResponseDto, Fqcn
+
+
+class _Pending:
+    __slots__ = (
+        'batches', 'parallelism', 'peripherals', 'writes', 'batch_peripherals', 'done', 'response', 'error', 'resend'
+    )
+
+    def __init__(
+            self,
+            batches: list[str],
+            parallelism: int,
+            peripherals: tuple[str, ...],
+            writes: tuple[Fqcn, ...],
+            batch_peripherals: tuple[tuple[str, ...], ...],
+    ):
+        self.batches = batches
+        self.parallelism = parallelism
+        self.peripherals = peripherals
+        self.writes = writes
+        self.batch_peripherals = batch_peripherals
+        self.done = threading.Event()
+        self.response: Optional[PeripheralIoResponseDto] = None
+        self.error: Optional[BaseException] = None
+        # the merged request failed; this read-only item should be sent on its own
+        self.resend = False
+
+
+class _Group:
+    __slots__ = ('items', 'size', 'full')
+
+    def __init__(self):
+        self.items: list[_Pending] = []
+        self.size = 0
+        self.full = threading.Event()
+
+
+class CoalescingClient:
+    """
+    Wraps a `BleCollectorClient` and merges `write_read_peripheral_value` calls that hit the same adapter within
+    `window` seconds into one multi-batch request, then hands every caller its own slice of `batch_responses`.
+    A call made while no other request to its adapter is in flight is sent at once.
+
+    Requests that rely on their batches running one after another (several batches with parallelism=1, like the
+    fused Expander transactions) are sent as they are. A merged request runs with the largest parallelism its
+    callers asked for, capped by the number of peripherals it talks to. If it fails, callers that only read
+    resend their own request; callers that write get the error, as their writes may already have run.
+    """
+
+    def __init__(self, client, window: float = 0.005, max_batches: int = 256, max_parallelism: int = 64):
+        self.client = client
+        self.window = window
+        self.max_batches = max_batches
+        self.max_parallelism = max_parallelism
+        self._groups: dict[str, _Group] = {}
+        self._in_flight: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self.requests_in = 0
+        self.requests_out = 0
+
+    def list_adapters(self):
+        return self.client.list_adapters()
+
+    def describe_adapters(self):
+        return self.client.describe_adapters()
+
+    @staticmethod
+    def _is_ordered(io_request) -> bool:
+        return io_request.parallelism <= 1 and len(io_request.batches) > 1
+
+    def write_read_peripheral_value(self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest):
+        with self._lock:
+            self.requests_in += 1
+        if self._is_ordered(io_request) or len(io_request.batches) >= self.max_batches:
+            return self._send(adapter_id, io_request)
+
+        batches = io_request.batches
+        if not isinstance(io_request, EncodedIoRequest):
+            batches = [*map(encode_batch, batches)]
+        pending = _Pending(
+            batches,
+            min(io_request.parallelism, len(batches)),
+            request_peripherals(io_request),
+            request_writes(io_request),
+            request_batch_peripherals(io_request),
+        )
+
+        with self._lock:
+            group = self._groups.get(adapter_id)
+            is_leader = group is None
+            if is_leader:
+                group = self._groups[adapter_id] = _Group()
+                # nothing to wait for: a solitary call should not pay the window
+                idle = not self._in_flight[adapter_id]
+            group.items.append(pending)
+            group.size += len(batches)
+            if group.size >= self.max_batches:
+                del self._groups[adapter_id]
+                group.full.set()
+
+        if is_leader:
+            if idle or not group.full.wait(self.window):
+                with self._lock:
+                    if self._groups.get(adapter_id) is group:
+                        del self._groups[adapter_id]
+            self._flush(adapter_id, group)
+        else:
+            pending.done.wait()
+
+        if pending.resend:
+            return self._send(adapter_id, io_request)
+        if pending.error is not None:
+            raise pending.error
+        return pending.response
+
+    def _send(self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest):
+        with self._lock:
+            self.requests_out += 1
+            self._in_flight[adapter_id] += 1
+        try:
+            return self.client.write_read_peripheral_value(adapter_id, io_request)
+        finally:
+            with self._lock:
+                self._in_flight[adapter_id] -= 1
+
+    def _flush(self, adapter_id: str, group: _Group):
+        items = group.items
+        try:
+            if len(items) == 1:
+                item = items[0]
+                request = EncodedIoRequest(
+                    item.batches, item.parallelism, item.peripherals, item.writes, item.batch_peripherals
+                )
+            else:
+                peripherals = tuple(dict.fromkeys(p for item in items for p in item.peripherals))
+                request = EncodedIoRequest(
+                    [batch for item in items for batch in item.batches],
+                    parallelism=max(1, min(
+                        self.max_parallelism, max(item.parallelism for item in items), len(peripherals)
+                    )),
+                    peripherals=peripherals,
+                    writes=tuple(fqcn for item in items for fqcn in item.writes),
+                    batch_peripherals=tuple(
+                        peripherals for item in items for peripherals in item.batch_peripherals
+                    ) if all(item.batch_peripherals for item in items) else (),
+                )
+            response = self._send(adapter_id, request)
+
+            offset = 0
+            for item in items:
+                size = len(item.batches)
+                item.response = PeripheralIoResponseDto(response.batch_responses[offset:offset + size])
+                offset += size
+        except Exception as e:
+            for item in items:
+                if len(items) > 1 and not item.writes:
+                    item.resend = True
+                else:
+                    item.error = e
+        except BaseException as e:
+            for item in items:
+                item.error = e
+        finally:
+            for item in items:
+                item.done.set()
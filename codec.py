@@ -0,0 +1,204 @@
+"""
+Hand-specialised JSON codec for the `/io` endpoint DTOs.
+
+`dataclasses_json` walks every field through reflection and the result still needs a `drop_nulls` pass;
+on batches of hundreds of commands that dominates the client CPU time. The encoders here write null-free
+JSON text straight from the DTO attributes and the decoder builds the response objects directly.
+"""
+from json.encoder import encode_basestring
+
+from dto import Fqcn, IoCommand, PeripheralIoRequestDto, PeripheralIoBatchRequestDto, PeripheralIoResponseDto, \
+    PeripheralIoBatchResponseDto, CommandResponse
+
+_BYTE_STRS = [str(i) for i in range(256)]
+
+
+def encode_fqcn(fqcn: Fqcn) -> str:
+    return (
+        f'{{"peripheral":{encode_basestring(fqcn.peripheral)},'
+        f'"service":{encode_basestring(fqcn.service)},'
+        f'"characteristic":{encode_basestring(fqcn.characteristic)}}}'
+    )
+
+
+def encode_value(value) -> str:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f'[{",".join(map(_BYTE_STRS.__getitem__, value))}]'
+    return f'[{",".join(map(str, value))}]'
+
+
+def encode_bool(value: bool) -> str:
+    return 'true' if value else 'false'
+
+
+def encode_command(command: IoCommand) -> str:
+    if (write := command.Write) is not None:
+        return (
+            f'{{"Write":{{"fqcn":{encode_fqcn(write.fqcn)},'
+            f'"value":{encode_value(write.value)},'
+            f'"wait_response":{encode_bool(write.wait_response)},'
+            f'"timeout_ms":{int(write.timeout_ms)}}}}}'
+        )
+    if (read := command.Read) is not None:
+        return (
+            f'{{"Read":{{"fqcn":{encode_fqcn(read.fqcn)},'
+            f'"wait_notification":{encode_bool(read.wait_notification)},'
+            f'"timeout_ms":{int(read.timeout_ms)}}}}}'
+        )
+    return '{}'
+
+
+def encode_batch(batch: PeripheralIoBatchRequestDto) -> str:
+    return (
+        f'{{"commands":[{",".join(map(encode_command, batch.commands))}],'
+        f'"parallelism":{int(batch.parallelism)}}}'
+    )
+
+
+class EncodedIoRequest:
+    """
+    Request whose batches are already serialized, e.g. rendered from a `templates.BatchTemplate`.
+    Accepted by the collector clients wherever a `PeripheralIoRequestDto` is.
+    """
+    __slots__ = ('batches', 'parallelism', 'peripherals', 'writes', 'batch_peripherals')
+
+    def __init__(
+            self,
+            batches: list[str],
+            parallelism: int,
+            peripherals: tuple[str, ...] = (),
+            writes: tuple[Fqcn, ...] = (),
+            batch_peripherals: tuple[tuple[str, ...], ...] = (),
+    ):
+        self.batches = batches
+        self.parallelism = parallelism
+        # addresses the batches talk to and characteristics they write; the batch JSON is opaque to the
+        # client-side layers
+        self.peripherals = peripherals
+        self.writes = writes
+        # per batch, the peripheral of every command, or a single address if all of its commands go there;
+        # empty if unknown
+        if not batch_peripherals and len(peripherals) == 1:
+            batch_peripherals = (peripherals,) * len(batches)
+        self.batch_peripherals = batch_peripherals
+
+    def encode(self) -> bytes:
+        return f'{{"batches":[{",".join(self.batches)}],"parallelism":{int(self.parallelism)}}}'.encode()
+
+
+def encode_io_request(request: PeripheralIoRequestDto | EncodedIoRequest) -> bytes:
+    if isinstance(request, EncodedIoRequest):
+        return request.encode()
+    return (
+        f'{{"batches":[{",".join(map(encode_batch, request.batches))}],'
+        f'"parallelism":{int(request.parallelism)}}}'
+    ).encode()
+
+
+def request_peripherals(request: PeripheralIoRequestDto | EncodedIoRequest) -> tuple[str, ...]:
+    if isinstance(request, EncodedIoRequest):
+        return request.peripherals
+    peripherals = {}
+    for batch in request.batches:
+        for command in batch.commands:
+            io = command.Write or command.Read
+            if io is not None:
+                peripherals[io.fqcn.peripheral] = None
+    return tuple(peripherals)
+
+
+def request_writes(request: PeripheralIoRequestDto | EncodedIoRequest) -> tuple[Fqcn, ...]:
+    if isinstance(request, EncodedIoRequest):
+        return request.writes
+    return tuple(
+        command.Write.fqcn for batch in request.batches for command in batch.commands if command.Write is not None
+    )
+
+
+def request_batch_peripherals(request: PeripheralIoRequestDto | EncodedIoRequest) -> tuple[tuple[str, ...], ...]:
+    """
+    Per batch, the peripheral of every command, or a single address if all of its commands go to it; empty if
+    the request does not tell.
+    """
+    if isinstance(request, EncodedIoRequest):
+        return request.batch_peripherals
+    return tuple(
+        tuple((command.Write or command.Read).fqcn.peripheral for command in batch.commands)
+        for batch in request.batches
+    )
+
+
+def command_peripheral(batch_peripherals: tuple[str, ...], index: int) -> str:
+    return batch_peripherals[index] if len(batch_peripherals) > 1 else batch_peripherals[0]
+
+
+def encoded_batch_parallelism(batch: str) -> int:
+    # `encode_batch` writes the parallelism last
+    return int(batch[batch.rindex(':') + 1:-1])
+
+
+def _with_parallelism(batch: str, parallelism: int) -> str:
+    return f'{batch[:batch.rindex(":") + 1]}{parallelism}}}'
+
+
+def _batch_parallelisms(request: PeripheralIoRequestDto | EncodedIoRequest) -> list[int]:
+    if isinstance(request, EncodedIoRequest):
+        return [*map(encoded_batch_parallelism, request.batches)]
+    return [max(1, min(batch.parallelism, len(batch.commands))) for batch in request.batches]
+
+
+def request_concurrency(request: PeripheralIoRequestDto | EncodedIoRequest) -> int:
+    """
+    Upper bound of the commands the collector runs at once for `request`: the batch parallelism of the
+    `request.parallelism` widest batches.
+    """
+    parallelisms = sorted(_batch_parallelisms(request), reverse=True)
+    return max(1, sum(parallelisms[:max(1, request.parallelism)]))
+
+
+def clamp_parallelism(
+        request: PeripheralIoRequestDto | EncodedIoRequest, limit: int
+) -> PeripheralIoRequestDto | EncodedIoRequest:
+    """
+    Returns a copy of the request that runs at most `limit` commands at once, see `request_concurrency`.
+
+    Batches that address a single peripheral keep a parallelism of 2: their commands may depend on running
+    together, like the Expander DATA_BUNDLE write and its RESULT notification.
+    """
+    batch_peripherals = request_batch_peripherals(request)
+    parallelisms = _batch_parallelisms(request)
+    clamped = []
+    for index, parallelism in enumerate(parallelisms):
+        single = index < len(batch_peripherals) and len(set(batch_peripherals[index])) == 1
+        clamped.append(min(parallelism, max(2, limit) if single else limit))
+    request_parallelism = max(1, min(request.parallelism, limit // max(clamped, default=1)))
+
+    if clamped == parallelisms and request_parallelism == request.parallelism:
+        return request
+    if isinstance(request, EncodedIoRequest):
+        return EncodedIoRequest(
+            [
+                batch if parallelism == original else _with_parallelism(batch, parallelism)
+                for batch, parallelism, original in zip(request.batches, clamped, parallelisms)
+            ],
+            request_parallelism, request.peripherals, request.writes, request.batch_peripherals,
+        )
+    return PeripheralIoRequestDto(batches=[
+        batch if parallelism == original else PeripheralIoBatchRequestDto(
+            commands=batch.commands, parallelism=parallelism
+        )
+        for batch, parallelism, original in zip(request.batches, clamped, parallelisms)
+    ], parallelism=request_parallelism)
+
+
+def _decode_command_response(data):
+    if data is None:
+        return None
+    return CommandResponse(data.get('Ok'), data.get('Error'))
+
+
+def decode_io_response(data: dict) -> PeripheralIoResponseDto:
+    return PeripheralIoResponseDto([
+        PeripheralIoBatchResponseDto([*map(_decode_command_response, batch['command_responses'])])
+        for batch in data['batch_responses']
+    ])
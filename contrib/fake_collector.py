@@ -0,0 +1,518 @@
+"""
+Local stand-in for the BLE collector, for integration tests and benchmarks.
+
+Serves `/ble/adapters`, `/ble/adapters/describe` and `/ble/adapters/{id}/io` on localhost and emulates expander
+peripherals (with an SCD41 behind the I2C bridge) and BME280 sensor boards. Latency, jitter and error injection
+are configurable and driven by a seeded RNG, so slow or flaky runs can be reproduced.
+
+    with FakeCollector(latency=0.01, seed=1) as collector:
+        collector.add_peripheral(FakeExpander('FA:6F:EC:EE:4B:36', i2c_devices={0x62: FakeSCD41()}))
+        client = BleCollectorClient(collector.address)
+"""
+import json
+import random
+import re
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Optional
+
+from ble_timeout_setter_service import TIMEOUT_MAP
+from bme_calibrator_service import BME280_SERVICE, TEMPERATURE_CH, PRESSURE_CH, HUMIDITY_CH, \
+    HUMIDITY_CALIBRATION_CH, TEMPERATURE_CALIBRATION_CH, PRESSURE_CALIBRATION_CH
+from contrib import scd
+from contrib.sensirion import crc8, pack_word
+from expander import Expander, DATA_BUNDLE_UUID, MISO_UUID, CS_UUID, LOCK_UUID, POWER_UUID, RESULT_UUID, ID_MAP
+
+
+class FakeBleError(Exception):
+    pass
+
+
+class FakePeripheral:
+    """
+    GATT value store with notifications. Subclasses hook `on_read`/`on_write` to emulate device behaviour.
+    """
+
+    def __init__(self, address: str, services: Optional[dict[str, dict[str, bytes]]] = None, clock=time.monotonic):
+        self.address = address
+        self.clock = clock
+        self.services: dict[str, dict[str, bytes]] = services or {}
+        self.reachable = True
+        self._versions: Counter[tuple[str, str]] = Counter()
+        self._condition = threading.Condition()
+
+    def add_characteristic(self, service: str, characteristic: str, value: bytes = b''):
+        self.services.setdefault(service, {})[characteristic] = bytes(value)
+
+    def _check(self, service: str, characteristic: str):
+        if not self.reachable:
+            raise FakeBleError(f'Peripheral {self.address} is not reachable')
+        if characteristic not in self.services.get(service, {}):
+            raise FakeBleError(f'Characteristic {service}/{characteristic} not found')
+
+    def version(self, service: str, characteristic: str) -> int:
+        with self._condition:
+            return self._versions[(service, characteristic)]
+
+    def read(self, service: str, characteristic: str) -> bytes:
+        self._check(service, characteristic)
+        return self.on_read(service, characteristic)
+
+    def write(self, service: str, characteristic: str, value: bytes):
+        self._check(service, characteristic)
+        self.on_write(service, characteristic, bytes(value))
+
+    def notify(self, service: str, characteristic: str, value: bytes):
+        with self._condition:
+            self.services[service][characteristic] = bytes(value)
+            self._versions[(service, characteristic)] += 1
+            self._condition.notify_all()
+
+    def wait_notification(self, service: str, characteristic: str, since: int, timeout: float) -> bytes:
+        """Waits for a notification newer than version `since`."""
+        self._check(service, characteristic)
+        key = (service, characteristic)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._versions[key] > since, timeout):
+                raise FakeBleError('Timeout waiting for notification')
+            return self.services[service][characteristic]
+
+    def on_read(self, service: str, characteristic: str) -> bytes:
+        return self.services[service][characteristic]
+
+    def on_write(self, service: str, characteristic: str, value: bytes):
+        self.services[service][characteristic] = value
+
+
+class FakeI2cDevice:
+    def write(self, data: bytes):
+        pass
+
+    def read(self, size: int) -> bytes:
+        return bytes(size)
+
+
+class FakeSCD41(FakeI2cDevice):
+    """
+    SCD41 command set: periodic/low-power measurement on a sensor clock, data ready, serial number,
+    temperature offset, altitude and ASC settings, all framed with Sensirion CRCs.
+    """
+
+    def __init__(self, serial_number: int = 0x0123_4567_89AB, co2: int = 600, temperature: float = 22.5,
+                 humidity: float = 45.0, clock: Callable[[], float] = time.monotonic):
+        self.serial_number = serial_number
+        self.co2 = co2
+        self.temperature = temperature
+        self.humidity = humidity
+        self.clock = clock
+        self.temperature_offset = 4 * (1 << 16) // 175
+        self.altitude = 0
+        self.asc_enabled = 1
+        self.interval: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.samples_read = 0
+        self.response = b''
+        self.crc_errors = 0
+
+    def power_cycle(self):
+        self.interval = None
+        self.started_at = None
+        self.response = b''
+
+    @property
+    def measuring(self) -> bool:
+        return self.started_at is not None
+
+    def _samples_available(self) -> int:
+        if not self.measuring:
+            return 0
+        return int((self.clock() - self.started_at) // self.interval)
+
+    def _respond(self, *words: int):
+        self.response = b''.join(pack_word(word & 0xFFFF) for word in words)
+
+    def write(self, data: bytes):
+        command = int.from_bytes(data[:2], 'big')
+        value = None
+        if len(data) >= 5:
+            if crc8(data[2:4]) != data[4]:
+                self.crc_errors += 1
+                raise FakeBleError('SCD41: CRC mismatch')
+            value = int.from_bytes(data[2:4], 'big')
+
+        self.response = b''
+        match command:
+            case scd.START_PERIODIC_MEASUREMENT | scd.START_LOW_POWER_PERIODIC_MEASUREMENT:
+                low_power = command == scd.START_LOW_POWER_PERIODIC_MEASUREMENT
+                self.interval = scd.LOW_POWER_PERIODIC_INTERVAL if low_power else scd.PERIODIC_INTERVAL
+                self.started_at = self.clock()
+                self.samples_read = 0
+            case scd.STOP_PERIODIC_MEASUREMENT:
+                self.interval = None
+                self.started_at = None
+            case scd.DATA_READY:
+                self._respond(0x8006 if self._samples_available() > self.samples_read else 0x8000)
+            case scd.READ_MEASUREMENT:
+                self.samples_read = self._samples_available()
+                self._respond(
+                    self.co2,
+                    int((self.temperature + 45) * (1 << 16) / 175),
+                    int(self.humidity * (1 << 16) / 100),
+                )
+            case scd.SERIAL_NUMBER:
+                self._require_idle()
+                self._respond(self.serial_number >> 32, self.serial_number >> 16, self.serial_number)
+            case scd.GET_TEMP_OFFSET:
+                self._respond(self.temperature_offset)
+            case scd.SET_TEMP_OFFSET:
+                self.temperature_offset = value
+            case scd.GET_ALTITUDE:
+                self._respond(self.altitude)
+            case scd.SET_ALTITUDE:
+                self.altitude = value
+            case scd.GET_ASCE:
+                self._respond(self.asc_enabled)
+            case scd.SET_ASCE:
+                self.asc_enabled = value
+            case scd.SET_PRESSURE | scd.PERSIST_SETTINGS | scd.SOFT_RESET | scd.FACTORY_RESET:
+                pass
+            case _:
+                raise FakeBleError(f'SCD41: unknown command 0x{command:04x}')
+
+    def _require_idle(self):
+        if self.measuring:
+            raise FakeBleError('SCD41: command not allowed during periodic measurement')
+
+    def read(self, size: int) -> bytes:
+        response, self.response = self.response, b''
+        return response[:size].ljust(size, b'\x00')
+
+
+class FakeExpander(FakePeripheral):
+    """
+    Expander GATT service: a DATA_BUNDLE write (see `util.pack_data_bundle`) runs an I2C command against
+    `i2c_devices`, posts the result code as a RESULT notification and leaves the read data in MISO.
+    """
+    ADDRESS_NACK = -8
+
+    def __init__(self, address: str, i2c_devices: Optional[dict[int, FakeI2cDevice]] = None, clock=time.monotonic):
+        super().__init__(address, clock=clock)
+        self.i2c_devices = i2c_devices or {}
+        self.bundles = 0
+        for characteristic in (DATA_BUNDLE_UUID, MISO_UUID, CS_UUID, LOCK_UUID, POWER_UUID, RESULT_UUID):
+            self.add_characteristic(Expander.SERVICE_UUID, characteristic)
+
+    def on_write(self, service: str, characteristic: str, value: bytes):
+        if characteristic == RESULT_UUID or characteristic == MISO_UUID:
+            raise FakeBleError('Characteristic is not writable')
+        self.services[service][characteristic] = value
+        result = ID_MAP[characteristic]
+        if characteristic == DATA_BUNDLE_UUID:
+            self.bundles += 1
+            try:
+                self.services[service][MISO_UUID] = self._execute(value)
+            except FakeBleError:
+                result = self.ADDRESS_NACK
+        self.notify(service, RESULT_UUID, result.to_bytes(1, 'little', signed=True))
+
+    def _execute(self, bundle: bytes) -> bytes:
+        command = bundle[7]
+        address = bundle[8]
+        size_read = int.from_bytes(bundle[9:11], 'little')
+        size_write = int.from_bytes(bundle[11:13], 'little')
+        mosi = bundle[16:16 + size_write]
+
+        if command == 3:
+            return bytes(sorted(self.i2c_devices))
+
+        device = self.i2c_devices.get(address)
+        if device is None:
+            raise FakeBleError(f'No I2C device at 0x{address:02x}')
+        if command in (0, 2) and size_write:
+            device.write(mosi)
+        if command in (1, 2) and size_read:
+            return device.read(size_read)
+        return b''
+
+
+class FakeBme280(FakePeripheral):
+    """
+    BME280 board: sensor characteristics derived from true values plus the calibration offsets, with
+    Gaussian noise; also exposes the notification timeout characteristics of `TIMEOUT_MAP`.
+    """
+
+    def __init__(self, address: str, temperature: float = 21.0, pressure: float = 101325.0, humidity: float = 50.0,
+                 noise: float = 0.0, seed: int = 0, clock=time.monotonic):
+        super().__init__(address, clock=clock)
+        self.temperature = temperature
+        self.pressure = pressure
+        self.humidity = humidity
+        self.noise = noise
+        self._random = random.Random(seed)
+        self._notifier_stopped: Optional[threading.Event] = None
+        for characteristic in (TEMPERATURE_CH, PRESSURE_CH, HUMIDITY_CH):
+            self.add_characteristic(BME280_SERVICE, characteristic)
+        for characteristic in (HUMIDITY_CALIBRATION_CH, TEMPERATURE_CALIBRATION_CH, PRESSURE_CALIBRATION_CH):
+            self.add_characteristic(BME280_SERVICE, characteristic, struct.pack('<f', 0.0))
+        for service_uuid, characteristic_uuid in TIMEOUT_MAP.values():
+            self.add_characteristic(service_uuid, characteristic_uuid, (0).to_bytes(4, 'little'))
+
+    def offset(self, characteristic: str) -> float:
+        return struct.unpack('<f', self.services[BME280_SERVICE][characteristic])[0]
+
+    def sample(self, characteristic: str) -> bytes:
+        noise = self._random.gauss(0, self.noise) if self.noise else 0.0
+        if characteristic == TEMPERATURE_CH:
+            value = self.temperature + self.offset(TEMPERATURE_CALIBRATION_CH) + noise
+            return int(round(value * 100)).to_bytes(2, 'little', signed=True)
+        if characteristic == PRESSURE_CH:
+            value = self.pressure + self.offset(PRESSURE_CALIBRATION_CH) + noise * 10
+            return int(round(value * 10)).to_bytes(4, 'little', signed=True)
+        value = self.humidity + self.offset(HUMIDITY_CALIBRATION_CH) + noise
+        return int(round(value * 100)).to_bytes(2, 'little', signed=True)
+
+    def on_read(self, service: str, characteristic: str) -> bytes:
+        if service == BME280_SERVICE and characteristic in (TEMPERATURE_CH, PRESSURE_CH, HUMIDITY_CH):
+            return self.sample(characteristic)
+        return self.services[service][characteristic]
+
+    def start_notifications(self, interval: float) -> 'FakeBme280':
+        """
+        Pushes a fresh sample of every sensor characteristic each `interval` seconds, like the firmware does
+        while notifications are enabled.
+        """
+        self.stop_notifications()
+        stopped = self._notifier_stopped = threading.Event()
+
+        def notify_forever():
+            while not stopped.wait(interval):
+                if not self.reachable:
+                    continue
+                for characteristic in (TEMPERATURE_CH, PRESSURE_CH, HUMIDITY_CH):
+                    self.notify(BME280_SERVICE, characteristic, self.sample(characteristic))
+
+        threading.Thread(target=notify_forever, name=f'notify-{self.address}', daemon=True).start()
+        return self
+
+    def stop_notifications(self):
+        if self._notifier_stopped is not None:
+            self._notifier_stopped.set()
+            self._notifier_stopped = None
+
+
+class FakeCollector:
+    """
+    Threaded HTTP server speaking the collector API on top of fake peripherals.
+
+    :param latency: seconds every BLE command takes, plus up to `jitter` extra
+    :param error_rate: probability a command returns an injected error
+    :param http_error_rate: probability a whole `/io` call fails with HTTP 500
+    """
+
+    def __init__(
+            self,
+            adapter_id: str = 'hci0',
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            error_rate: float = 0.0,
+            http_error_rate: float = 0.0,
+            seed: int = 0,
+            host: str = '127.0.0.1',
+            port: int = 0,
+    ):
+        self.adapter_id = adapter_id
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.peripherals: dict[str, FakePeripheral] = {}
+        self.http_calls: Counter[str] = Counter()
+        self.commands: Counter[str] = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add_peripheral(self, peripheral: FakePeripheral) -> FakePeripheral:
+        self.peripherals[peripheral.address] = peripheral
+        return peripheral
+
+    def remove_peripheral(self, address: str):
+        self.peripherals.pop(address, None)
+
+    def reset_counters(self):
+        with self._lock:
+            self.http_calls.clear()
+            self.commands.clear()
+
+    def start(self) -> 'FakeCollector':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-collector', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, endpoint: str):
+        with self._lock:
+            self.http_calls[endpoint] += 1
+
+    def _roll(self, probability: float) -> bool:
+        if not probability:
+            return False
+        with self._lock:
+            return self._random.random() < probability
+
+    def _sleep(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                extra = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+            time.sleep(self.latency + extra)
+
+    def adapters(self):
+        return [{'id': self.adapter_id, 'modalias': 'usb:fake'}]
+
+    def describe(self):
+        return [{
+            'adapter_info': self.adapters()[0],
+            'peripherals': [
+                {
+                    'id': f'/org/bluez/{self.adapter_id}/dev_{address.replace(":", "_")}',
+                    'address': address,
+                    'props': None,
+                    'services': [
+                        {
+                            'uuid': service_uuid,
+                            'primary': True,
+                            'characteristics': [
+                                {
+                                    'uuid': characteristic_uuid,
+                                    'service_uuid': service_uuid,
+                                    'properties': ['Read', 'Write', 'Notify'],
+                                    'descriptors': [],
+                                }
+                                for characteristic_uuid in characteristics
+                            ],
+                        }
+                        for service_uuid, characteristics in peripheral.services.items()
+                    ],
+                }
+                for address, peripheral in self.peripherals.items()
+            ],
+        }]
+
+    def _command(self, command: dict, since: dict) -> dict:
+        kind, body = next(iter(command.items()))
+        fqcn = body['fqcn']
+        with self._lock:
+            self.commands[kind] += 1
+        self._sleep()
+        try:
+            if self._roll(self.error_rate):
+                raise FakeBleError('Injected error')
+            peripheral = self.peripherals.get(fqcn['peripheral'])
+            if peripheral is None:
+                raise FakeBleError(f'Peripheral {fqcn["peripheral"]} not found')
+            if kind == 'Write':
+                peripheral.write(fqcn['service'], fqcn['characteristic'], bytes(body['value']))
+                return {'Ok': None}
+            if body['wait_notification']:
+                key = (fqcn['peripheral'], fqcn['service'], fqcn['characteristic'])
+                value = peripheral.wait_notification(
+                    fqcn['service'], fqcn['characteristic'], since[key], body['timeout_ms'] / 1000
+                )
+            else:
+                value = peripheral.read(fqcn['service'], fqcn['characteristic'])
+            return {'Ok': [*value]}
+        except FakeBleError as e:
+            return {'Error': {'message': str(e)}}
+
+    def _batch(self, batch: dict) -> dict:
+        # notifications are subscribed before any command of the batch runs, like the collector does
+        since = {}
+        for command in batch['commands']:
+            read = command.get('Read')
+            if read is not None and read['wait_notification']:
+                fqcn = read['fqcn']
+                peripheral = self.peripherals.get(fqcn['peripheral'])
+                if peripheral is not None:
+                    key = (fqcn['peripheral'], fqcn['service'], fqcn['characteristic'])
+                    since[key] = peripheral.version(fqcn['service'], fqcn['characteristic'])
+
+        commands = batch['commands']
+        results = _map(lambda command: self._command(command, since), commands, batch['parallelism'])
+        return {'command_responses': results}
+
+    def io(self, request: dict) -> dict:
+        return {'batch_responses': _map(self._batch, request['batches'], request['parallelism'])}
+
+    def _handler_class(self):
+        collector = self
+        io_path = re.compile(r'^/ble/adapters/([^/]+)/io$')
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # headers and body go out in separate writes; don't let Nagle hold the body back
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, data):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/ble/adapters':
+                    collector._count('adapters')
+                    return self._send(200, {'data': collector.adapters()})
+                if self.path == '/ble/adapters/describe':
+                    collector._count('describe')
+                    return self._send(200, {'data': collector.describe()})
+                self._send(404, {'error': f'Unknown path {self.path}'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                match = io_path.match(self.path)
+                if match is None or match.group(1) != collector.adapter_id:
+                    return self._send(404, {'error': f'Unknown path {self.path}'})
+                collector._count('io')
+                if collector._roll(collector.http_error_rate):
+                    return self._send(500, {'error': 'Injected HTTP error'})
+                self._send(200, {'data': collector.io(request)})
+
+        return Handler
+
+
+def _map(fn, items: list, parallelism: int) -> list:
+    workers = min(max(parallelism, 1), len(items))
+    if workers <= 1:
+        return [*map(fn, items)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [*executor.map(fn, items)]
@@ -1,6 +1,13 @@
+import asyncio
+import math
 import struct
 import time
 
+from loguru import logger
+
+from cache import i2c_key
+from contrib.sensirion import CRC8_POLYNOMIAL, crc8, build_crc8_table, pack_word, unpack_words
+from tracing import span
 from util import i2c_msg
 
 SOFT_RESET = 0x3646
@@ -25,52 +32,110 @@ SET_ASCE = 0x2416
 
 DEFAULT_I2C_ADDRESS = 0x62
 
+PERIODIC_INTERVAL = 5.0
+LOW_POWER_PERIODIC_INTERVAL = 30.0
+
+# reads served from the bus cache (see `cache.ReadCache`), with their TTL in seconds; settings not persisted
+# with PERSIST_SETTINGS are lost on a brown-out, so they are kept short
+CACHED_READS = {
+    SERIAL_NUMBER: 86400.0,
+    GET_TEMP_OFFSET: 300.0,
+    GET_ALTITUDE: 300.0,
+    GET_ASCE: 300.0,
+}
+# cached reads of volatile settings
+SETTINGS_READS = (GET_TEMP_OFFSET, GET_ALTITUDE, GET_ASCE)
+# commands that change what the cached reads return
+INVALIDATES = {
+    SET_TEMP_OFFSET: (GET_TEMP_OFFSET,),
+    SET_ALTITUDE: (GET_ALTITUDE,),
+    SET_ASCE: (GET_ASCE,),
+    SOFT_RESET: SETTINGS_READS,
+    FACTORY_RESET: SETTINGS_READS,
+}
+
 
 class SCD4X:
-    def __init__(self, bus, address=DEFAULT_I2C_ADDRESS, quiet=True):
+    # data_ready re-checks after the expected sample time: 0.1, 0.2, 0.4, ... capped at 1 s
+    poll_backoff_min = 0.1
+    poll_backoff_max = 1.0
+
+    def __init__(self, bus, address=DEFAULT_I2C_ADDRESS, quiet=True, cached_serial=True):
         self.co2 = 0
         self.temperature = 0
         self.relative_humidity = 0
         self.address = address
         self.bus = bus
 
+        self.interval = None
+        self.periodic_started_at = None
+        self.last_read_at = None
+
         self.stop_periodic_measurement()
 
-        serial = self.get_serial_number()
+        serial = self.serial_number = self.get_serial_number(cached=cached_serial)
 
         if not quiet:
             print(f"SCD4X, Serial: {serial:06x}")
 
+    def _cache_key(self, command):
+        return i2c_key(self.bus.peripheral_address, self.address, command)
+
+    def invalidate_cache(self, commands=tuple(CACHED_READS)):
+        cache = getattr(self.bus, 'cache', None)
+        if cache is not None:
+            for command in commands:
+                cache.invalidate(self._cache_key(command))
+
+    def cached_rdwr(self, command, response_length=0, delay=0, refresh=False):
+        """
+        `rdwr` of a read command, served from the bus cache when the bus has one and the command is in
+        `CACHED_READS`. With `refresh` the command goes to the sensor and its response replaces the cached one.
+        """
+        cache = getattr(self.bus, 'cache', None)
+        ttl = CACHED_READS.get(command)
+        if cache is None or ttl is None:
+            return self.rdwr(command, response_length=response_length, delay=delay)
+
+        key = self._cache_key(command)
+        response = None if refresh else cache.get(key)
+        if response is None:
+            response = self.rdwr(command, response_length=response_length, delay=delay)
+            cache.put(key, tuple(response) if isinstance(response, list) else response, ttl)
+        return response
+
     def rdwr(self, command, value=None, response_length=0, delay=0):
-        if value is not None:
-            msg_w = i2c_msg.write(
-                self.address, struct.pack(">HHB", command, value, self.crc8(value))
-            )
-        else:
-            msg_w = i2c_msg.write(self.address, struct.pack(">H", command))
+        if command in INVALIDATES:
+            # before the write too: a failed write may still have landed
+            self.invalidate_cache(INVALIDATES[command])
+        with span('SCD4X.rdwr', command=f'0x{command:04x}', delay_ms=delay, response_words=response_length):
+            if value is not None:
+                msg_w = i2c_msg.write(self.address, struct.pack(">H", command) + pack_word(value))
+            else:
+                msg_w = i2c_msg.write(self.address, struct.pack(">H", command))
 
-        self.bus.i2c_rdwr(msg_w)
+            self.bus.i2c_rdwr(msg_w)
 
-        time.sleep(delay / 1000.0)
+            if command in INVALIDATES:
+                self.invalidate_cache(INVALIDATES[command])
 
-        response_length *= 3
+            if delay:
+                with span('SCD4X.delay', delay_ms=delay):
+                    time.sleep(delay / 1000.0)
 
-        if response_length > 0:
-            msg_r = i2c_msg.read(self.address, response_length)
-            self.bus.i2c_rdwr(msg_r)
+            response_length *= 3
 
-            result = list(msg_r)
-            data = []
-            for chunk in range(0, len(result), 3):
-                if self.crc8(result[chunk : chunk + 2]) != result[chunk + 2]:
-                    raise ValueError("ICP10125: Invalid CRC8 in response.")
-                data.append((result[chunk] << 8) | result[chunk + 1])
-            if len(data) == 1:
-                return data[0]
-            else:
-                return data
+            if response_length > 0:
+                msg_r = i2c_msg.read(self.address, response_length)
+                self.bus.i2c_rdwr(msg_r)
+
+                data = unpack_words(msg_r.buf)
+                if len(data) == 1:
+                    return data[0]
+                else:
+                    return data
 
-        return []
+            return []
 
     def reset(self):
         """Resets to user settings from EEPROM"""
@@ -91,16 +156,63 @@ class SCD4X:
         if response > 0:
             raise RuntimeError("Self test failed!")
 
+    def next_ready_at(self):
+        """Monotonic time the next periodic sample is expected at, or None if the cadence is unknown."""
+        if self.periodic_started_at is None:
+            return None
+        if self.last_read_at is None:
+            samples = 1
+        else:
+            samples = math.floor((self.last_read_at - self.periodic_started_at) / self.interval) + 1
+        return self.periodic_started_at + samples * self.interval
+
+    def _poll_delays(self, timeout):
+        """
+        Yields how long to sleep before each data_ready check: first until the expected sample time,
+        then with exponential backoff.
+        """
+        now = time.monotonic()
+        deadline = now + timeout
+        ready_at = self.next_ready_at()
+        delay = 0.0 if ready_at is None else max(0.0, ready_at - now)
+        backoff = self.poll_backoff_min
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError("Timeout waiting for data ready.")
+            yield min(delay, remaining)
+            delay = backoff
+            backoff = min(backoff * 2, self.poll_backoff_max)
+
     def measure(self, blocking=True, timeout=10):
-        t_start = time.time()
-        while not self.data_ready():
-            if not blocking:
+        if not blocking:
+            if not self.data_ready():
                 return
-            if time.time() - t_start > timeout:
-                raise RuntimeError("Timeout waiting for data ready.")
-            time.sleep(0.1)
+            return self.read_measurement()
+
+        with span('SCD4X.measure', timeout=timeout):
+            for delay in self._poll_delays(timeout):
+                with span('SCD4X.poll_wait', delay_s=round(delay, 3)):
+                    time.sleep(delay)
+                if self.data_ready():
+                    break
+
+            return self.read_measurement()
+
+    async def measure_async(self, timeout=10):
+        """
+        Same as `measure`, but waits with `asyncio.sleep`; the blocking bus I/O runs in a worker thread.
+        """
+        for delay in self._poll_delays(timeout):
+            await asyncio.sleep(delay)
+            if await asyncio.to_thread(self.data_ready):
+                break
 
+        return await asyncio.to_thread(self.read_measurement)
+
+    def read_measurement(self):
         response = self.rdwr(READ_MEASUREMENT, response_length=3, delay=1)
+        self.last_read_at = time.monotonic()
         self.co2 = response[0]
         self.temperature = -45 + 175.0 * response[1] / (1 << 16)
         self.relative_humidity = 100.0 * response[2] / (1 << 16)
@@ -111,18 +223,25 @@ class SCD4X:
         response = self.rdwr(DATA_READY, response_length=1, delay=1)
         return (response & 0x07FF) != 0
 
-    def get_serial_number(self):
-        response = self.rdwr(SERIAL_NUMBER, response_length=3, delay=1)
+    def get_serial_number(self, cached=True):
+        response = self.cached_rdwr(SERIAL_NUMBER, response_length=3, delay=1, refresh=not cached)
         return (response[0] << 32) | (response[1] << 16) | response[2]
 
     def start_periodic_measurement(self, low_power=False):
         if low_power:
             self.rdwr(START_LOW_POWER_PERIODIC_MEASUREMENT)
+            self.interval = LOW_POWER_PERIODIC_INTERVAL
         else:
             self.rdwr(START_PERIODIC_MEASUREMENT)
+            self.interval = PERIODIC_INTERVAL
+        self.periodic_started_at = time.monotonic()
+        self.last_read_at = None
 
     def stop_periodic_measurement(self):
         self.rdwr(STOP_PERIODIC_MEASUREMENT, delay=500)
+        self.interval = None
+        self.periodic_started_at = None
+        self.last_read_at = None
 
     def set_ambient_pressure(self, ambient_pressure):
         self.rdwr(SET_PRESSURE, value=ambient_pressure)
@@ -134,34 +253,87 @@ class SCD4X:
         self.rdwr(SET_TEMP_OFFSET, value=offset)
 
     def get_temperature_offset(self):
-        response = self.rdwr(GET_TEMP_OFFSET, response_length=1, delay=1)
+        response = self.cached_rdwr(GET_TEMP_OFFSET, response_length=1, delay=1)
         return 175.0 * response / (1 << 16)
 
     def set_altitude(self, altitude):
         self.rdwr(SET_ALTITUDE, value=altitude)
 
     def get_altitude(self):
-        return self.rdwr(GET_ALTITUDE, response_length=1, delay=1)
+        return self.cached_rdwr(GET_ALTITUDE, response_length=1, delay=1)
 
     def set_automatic_self_calibration_enabled(self, value):
         self.rdwr(SET_ASCE, value=int(value))
 
     def get_automatic_self_calibration_enabled(self):
-        return bool(self.rdwr(GET_ASCE, response_length=1, delay=1))
+        return bool(self.cached_rdwr(GET_ASCE, response_length=1, delay=1))
 
     def persist_settings(self):
         self.rdwr(PERSIST_SETTINGS, delay=800)
 
-    def crc8(self, data, polynomial=0x31):
-        if isinstance(data, int):
-            data = [(data >> 8) & 0xFF, data & 0xFF]
-        result = 0xFF
-        for byte in data:
-            result ^= byte
-            for bit in range(8):
-                if result & 0x80:
-                    result <<= 1
-                    result ^= polynomial
-                else:
-                    result <<= 1
-        return result & 0xFF
+    def crc8(self, data, polynomial=CRC8_POLYNOMIAL):
+        if polynomial == CRC8_POLYNOMIAL:
+            return crc8(data)
+        return crc8(data, build_crc8_table(polynomial))
+
+
+class SCD4XSession:
+    """
+    Long-lived SCD4X handle that keeps periodic measurement running between polls.
+
+    The sensor is (re)initialised lazily: on first use, after any failed poll, and when no sample shows up
+    within two periods of the expected time, which means the sensor was power-cycled and is idle.
+    """
+    stall_periods = 2
+
+    def __init__(self, bus, address=DEFAULT_I2C_ADDRESS, low_power=False, quiet=True):
+        self.bus = bus
+        self.address = address
+        self.low_power = low_power
+        self.quiet = quiet
+        self.sensor = None
+        self.serial_number = None
+
+    def _initialise(self):
+        # a swapped or power-cycled sensor must not be hidden behind cached reads
+        sensor = SCD4X(self.bus, self.address, quiet=self.quiet, cached_serial=False)
+        sensor.invalidate_cache(SETTINGS_READS)
+        if self.serial_number is not None and sensor.serial_number != self.serial_number:
+            logger.warning(f'SCD4X serial changed: {self.serial_number:06x} -> {sensor.serial_number:06x}')
+        self.serial_number = sensor.serial_number
+        sensor.start_periodic_measurement(low_power=self.low_power)
+        self.sensor = sensor
+
+    def invalidate(self):
+        if self.sensor is not None:
+            self.sensor.invalidate_cache()
+        self.sensor = None
+
+    def _measure(self, timeout):
+        sensor = self.sensor
+        stall_timeout = max(0.0, sensor.next_ready_at() - time.monotonic()) + self.stall_periods * sensor.interval
+        try:
+            return sensor.measure(timeout=min(timeout, stall_timeout))
+        except RuntimeError:
+            if stall_timeout >= timeout:
+                raise
+            return None
+
+    def read(self, timeout=15):
+        with span('SCD4XSession.read', address=self.address):
+            if self.sensor is None:
+                with span('SCD4XSession.initialise'):
+                    self._initialise()
+
+            try:
+                result = self._measure(timeout)
+                if result is None:
+                    logger.warning(f'SCD4X {self.serial_number:06x} produced no sample, assuming a power cycle')
+                    with span('SCD4XSession.initialise'):
+                        self._initialise()
+                    result = self.sensor.measure(timeout=timeout)
+            except Exception:
+                self.invalidate()
+                raise
+
+            return result
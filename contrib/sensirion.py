@@ -0,0 +1,53 @@
+"""
+Helpers shared by Sensirion-style I2C drivers: big-endian 16-bit words, each followed by a CRC-8
+(polynomial 0x31, init 0xFF).
+"""
+import struct
+
+
+def build_crc8_table(polynomial: int) -> bytes:
+    table = bytearray(256)
+    for byte in range(256):
+        result = byte
+        for _ in range(8):
+            if result & 0x80:
+                result = ((result << 1) ^ polynomial) & 0xFF
+            else:
+                result = (result << 1) & 0xFF
+        table[byte] = result
+    return bytes(table)
+
+
+CRC8_POLYNOMIAL = 0x31
+CRC8_TABLE = build_crc8_table(CRC8_POLYNOMIAL)
+
+
+def crc8(data, table: bytes = CRC8_TABLE) -> int:
+    if isinstance(data, int):
+        data = ((data >> 8) & 0xFF, data & 0xFF)
+    result = 0xFF
+    for byte in data:
+        result = table[result ^ byte]
+    return result
+
+
+def pack_word(value: int) -> bytes:
+    """Packs a word followed by its CRC."""
+    return struct.pack('>HB', value, CRC8_TABLE[CRC8_TABLE[0xFF ^ ((value >> 8) & 0xFF)] ^ (value & 0xFF)])
+
+
+def unpack_words(buf) -> list[int]:
+    """
+    Checks and unpacks every (MSB, LSB, CRC) triplet of a response buffer in one pass.
+    """
+    data = memoryview(buf if isinstance(buf, (bytes, bytearray, memoryview)) else bytes(buf)).cast('B')
+    if len(data) % 3:
+        raise ValueError(f'Response length {len(data)} is not a multiple of 3.')
+
+    table = CRC8_TABLE
+    words = []
+    for msb, lsb, crc in zip(data[0::3], data[1::3], data[2::3]):
+        if table[table[0xFF ^ msb] ^ lsb] != crc:
+            raise ValueError('Invalid CRC8 in response.')
+        words.append((msb << 8) | lsb)
+    return words
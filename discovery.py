@@ -0,0 +1,145 @@
+import enum
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Any
+
+from loguru import logger
+
+from ble_timeout_setter_service import TIMEOUT_MAP
+from bme_calibrator_service import BME280_SERVICE
+from expander import Expander
+from scheduler import Scheduler, Job
+from switchbot_service import SwitchBotService
+from topology import TopologyCache
+
+
+class DeviceKind(enum.Enum):
+    EXPANDER = 'expander'
+    BME280 = 'bme280'
+    NOTIFICATION_TIMEOUTS = 'notification_timeouts'
+    SWITCHBOT = 'switchbot'
+
+
+TIMEOUT_SERVICES = frozenset(service_uuid for service_uuid, _ in TIMEOUT_MAP.values())
+
+
+def classify(services) -> frozenset[DeviceKind]:
+    kinds = set()
+    if Expander.SERVICE_UUID in services:
+        kinds.add(DeviceKind.EXPANDER)
+    if BME280_SERVICE in services:
+        kinds.add(DeviceKind.BME280)
+    if not TIMEOUT_SERVICES.isdisjoint(services):
+        kinds.add(DeviceKind.NOTIFICATION_TIMEOUTS)
+    if SwitchBotService.service_uuid in services:
+        kinds.add(DeviceKind.SWITCHBOT)
+    return frozenset(kinds)
+
+
+@dataclass
+class Device:
+    adapter_id: str
+    address: str
+    kinds: frozenset[DeviceKind]
+    # I2C addresses answering behind an expander; None until the probe succeeds
+    i2c_addresses: Optional[tuple[int, ...]] = None
+    jobs: list[str] = field(default_factory=list)
+
+
+class FleetDiscovery:
+    """
+    Polls the collector topology, classifies peripherals by the services they expose and keeps the scheduler's
+    per-device jobs in sync as devices appear, change or disappear.
+
+    Expanders are probed with `scan_i2c` once, so job factories know which sensors sit behind them.
+
+    Devices may share a job by returning jobs with the same name, e.g. one per adapter; it stays scheduled while
+    any of them is registered. `on_deregister` is called with every device whose jobs were removed.
+    """
+
+    def __init__(
+            self,
+            client,
+            scheduler: Scheduler,
+            topology: TopologyCache,
+            job_factory: Callable[[Device], list[Job]],
+            probe_timeout_ms: int = 10000,
+            on_deregister: Optional[Callable[[Device], Any]] = None,
+    ):
+        self.client = client
+        self.scheduler = scheduler
+        self.topology = topology
+        self.job_factory = job_factory
+        self.probe_timeout_ms = probe_timeout_ms
+        self.on_deregister = on_deregister
+        self.devices: dict[str, Device] = {}
+        # registered devices per job name
+        self._job_users: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def probe(self, device: Device):
+        expander = Expander(self.client, device.adapter_id, device.address, timeout_ms=self.probe_timeout_ms)
+        try:
+            device.i2c_addresses = tuple(expander.scan_i2c())
+            logger.info(f'[{device.address}] I2C devices: {[f"0x{a:02x}" for a in device.i2c_addresses]}')
+        except Exception as e:
+            logger.warning(f'[{device.address}] I2C probe failed: {e}')
+        finally:
+            try:
+                expander.set_lock(0)
+            except Exception as e:
+                logger.warning(f'[{device.address}] Failed to release Expander lock: {e}')
+
+    def _register(self, device: Device):
+        for job in self.job_factory(device):
+            if not self._job_users[job.name]:
+                self.scheduler.add(job)
+            self._job_users[job.name] += 1
+            device.jobs.append(job.name)
+        self.devices[device.address] = device
+        logger.info(f'[{device.address}] Registered {device.kinds} with jobs {device.jobs}')
+
+    def _deregister(self, address: str):
+        device = self.devices.pop(address)
+        for name in device.jobs:
+            self._job_users[name] -= 1
+            if not self._job_users[name]:
+                del self._job_users[name]
+                self.scheduler.remove(name)
+        logger.info(f'[{address}] Deregistered jobs {device.jobs}')
+        if self.on_deregister is not None:
+            self.on_deregister(device)
+
+    def poll(self):
+        with self._lock:
+            self.topology.refresh(force=True)
+
+            current = {}
+            for adapter in self.topology.adapters:
+                for peripheral in adapter.peripherals:
+                    kinds = classify(self.topology.services(peripheral.address))
+                    if kinds:
+                        current[peripheral.address] = (adapter.adapter_info.id, kinds)
+
+            for address in [*self.devices.keys() - current.keys()]:
+                self._deregister(address)
+
+            for address, (adapter_id, kinds) in current.items():
+                device = self.devices.get(address)
+                if device is not None and device.adapter_id == adapter_id and device.kinds == kinds:
+                    if DeviceKind.EXPANDER not in kinds or device.i2c_addresses is not None:
+                        continue
+                    # the previous probe failed: retry it, jobs only change if it succeeds now
+                    self.probe(device)
+                    if device.i2c_addresses is None:
+                        continue
+
+                if device is not None:
+                    self._deregister(address)
+                    device = Device(adapter_id, address, kinds, i2c_addresses=device.i2c_addresses)
+                else:
+                    device = Device(adapter_id, address, kinds)
+                if DeviceKind.EXPANDER in kinds and device.i2c_addresses is None:
+                    self.probe(device)
+                self._register(device)
@@ -13,7 +13,7 @@ class AdapterInfoDto:
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class Fqcn:
     peripheral: str
     service: str
@@ -21,16 +21,17 @@ class Fqcn:
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class IoWriteCommand:
     fqcn: Fqcn
-    value: list[int]
+    # bytes-like values are encoded as they are, without building an int list first
+    value: list[int] | bytes
     wait_response: bool
     timeout_ms: int
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class IoReadCommand:
     fqcn: Fqcn
     wait_notification: bool
@@ -38,13 +39,13 @@ class IoReadCommand:
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class IoCommand:
     Write: Optional[IoWriteCommand] = None
     Read: Optional[IoReadCommand] = None
 
     @classmethod
-    def write(cls, fqcn: Fqcn, value: list, wait_response: bool, timeout_ms: int):
+    def write(cls, fqcn: Fqcn, value: list | bytes, wait_response: bool, timeout_ms: int):
         return IoCommand(Write=IoWriteCommand(fqcn=fqcn, value=value, wait_response=wait_response, timeout_ms=timeout_ms))
 
     @classmethod
@@ -53,34 +54,34 @@ class IoCommand:
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class PeripheralIoBatchRequestDto:
     commands: list[IoCommand]
     parallelism: int
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class PeripheralIoRequestDto:
     batches: list[PeripheralIoBatchRequestDto]
     parallelism: int
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class CommandResponse:
     Ok: Optional[Any] = None
     Error: Optional[Any] = None
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class PeripheralIoBatchResponseDto:
     command_responses: list[Optional[CommandResponse]]
 
 
 @dataclass_json
-@dataclass
+@dataclass(slots=True)
 class PeripheralIoResponseDto:
     batch_responses: list[PeripheralIoBatchResponseDto]
 
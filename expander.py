@@ -1,12 +1,22 @@
+import contextlib
+import time
+from typing import Optional
+
 import typing_extensions
 from loguru import logger
 
 from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto, PeripheralIoBatchResponseDto, \
-    CommandResponse
+    CommandResponse, PeripheralIoResponseDto
+from cache import ReadCache, i2c_key
+from codec import EncodedIoRequest
+from metrics import BLE_COMMAND_SECONDS, EXPANDER_ERRORS, EXPANDER_BYTES
+from tracing import span
+from templates import TemplateCache, VALUE_SLOT, TIMEOUT_SLOT
 from util import pack_data_bundle, WriteMessage, ReadMessage
 
 if typing_extensions.TYPE_CHECKING:
     from ble_collector_client import BleCollectorClient
+    from async_ble_collector_client import AsyncBleCollectorClient
 
 DATA_BUNDLE_UUID = "0000a001-0000-1000-8000-00805f9b34fb"
 MISO_UUID = "0000a002-0000-1000-8000-00805f9b34fb"
@@ -23,6 +33,15 @@ ID_MAP = {
     RESULT_UUID: 5,
 }
 
+UUID_NAME_MAP = {
+    DATA_BUNDLE_UUID: 'DATA_BUNDLE',
+    MISO_UUID: 'MISO',
+    CS_UUID: 'CS',
+    LOCK_UUID: 'LOCK',
+    POWER_UUID: 'POWER',
+    RESULT_UUID: 'RESULT',
+}
+
 ID_NAME_MAP = {
     1: 'DATA_BUNDLE',
     2: 'CS',
@@ -41,16 +60,41 @@ class ExpanderError(Exception):
         return cls(f'Command {command_name} failed')
 
 
+@contextlib.contextmanager
+def _observe(operation: str, characteristic_uuid: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        BLE_COMMAND_SECONDS.labels(
+            operation=operation, characteristic=UUID_NAME_MAP.get(characteristic_uuid, 'UNKNOWN')
+        ).observe(time.perf_counter() - started_at)
+
+
 class Expander:
     SERVICE_UUID = 'ac866789-aaaa-eeee-a329-969d4bc8621e'
     power_wait: int = 1
     timeout_ms: int = 5000
-
-    def __init__(self, client: 'BleCollectorClient', adapter_id: str, peripheral_address: str, timeout_ms: int = 5000):
+    fused: bool = True
+    templates: TemplateCache = TemplateCache()
+    # attached I2C devices rarely change; seconds a scan_i2c result is served from the cache
+    scan_i2c_ttl: float = 3600.0
+
+    def __init__(
+            self, client: 'BleCollectorClient', adapter_id: str, peripheral_address: str, timeout_ms: int = 5000,
+            fused: bool = True, cache: Optional[ReadCache] = None,
+    ):
+        """
+        :param fused: send bundle write, RESULT and MISO reads of a transaction in one `/io` request
+        :param cache: cache of slow-changing I2C reads; defaults to the one of a `CachingClient`
+        """
         self.client = client
         self.peripheral_address = peripheral_address
         self.adapter_id = adapter_id
         self.timeout_ms = timeout_ms
+        self.fused = fused
+        self.cache = cache if cache is not None else getattr(client, 'cache', None)
+        self._fqcns: dict[tuple[str, ...], tuple[Fqcn, ...]] = {}
 
     @staticmethod
     def _build_batch(*commands, parallelism: int = 32):
@@ -89,29 +133,60 @@ class Expander:
             parallelism=parallelism
         )
 
-    def _client_read(self, characteristic_uuid: str):
-        request = self._build_request(
-            self._build_batch(
-                self._build_read(characteristic_uuid, wait_notification=False, timeout_ms=self.timeout_ms),
+    def _write_fqcns(self, writes: tuple[str, ...]) -> tuple[Fqcn, ...]:
+        fqcns = self._fqcns.get(writes)
+        if fqcns is None:
+            fqcns = self._fqcns[writes] = tuple(
+                Fqcn(peripheral=self.peripheral_address, service=self.SERVICE_UUID, characteristic=characteristic)
+                for characteristic in writes
+            )
+        return fqcns
+
+    def _build_encoded_request(self, batches: list[str], parallelism: int, writes: tuple[str, ...] = ()):
+        """
+        :param writes: characteristics of the Expander service the batches write
+        """
+        return EncodedIoRequest(
+            batches, parallelism=parallelism, peripherals=(self.peripheral_address,), writes=self._write_fqcns(writes)
+        )
+
+    def _read_batch_template(self, characteristic_uuid: str):
+        return self.templates.get(
+            (self.peripheral_address, characteristic_uuid, 'read'),
+            lambda: self._build_batch(
+                self._build_read(characteristic_uuid, wait_notification=False, timeout_ms=TIMEOUT_SLOT),
                 parallelism=1
-            ),
+            )
+        )
+
+    def _write_result_batch_template(self, write_characteristic_uuid: str):
+        return self.templates.get(
+            (self.peripheral_address, write_characteristic_uuid, 'write_result'),
+            lambda: self._build_batch(
+                self._build_write(write_characteristic_uuid, VALUE_SLOT, wait_response=False, timeout_ms=TIMEOUT_SLOT),
+                self._build_read(RESULT_UUID, timeout_ms=TIMEOUT_SLOT)
+            )
+        )
+
+    def _build_read_request(self, characteristic_uuid: str):
+        return self._build_encoded_request(
+            [self._read_batch_template(characteristic_uuid).render(timeout_ms=self.timeout_ms)],
             parallelism=1
         )
-        response = self.client.write_read_peripheral_value(self.adapter_id, request)
+
+    def _parse_read_response(self, response: PeripheralIoResponseDto):
         batch = response.batch_responses[0]
         self._validate_batch(batch)
         return batch.command_responses[0].Ok
 
-    def _client_write_read(self, write_characteristic_uuid: str, value):
-        request = self._build_request(
-            self._build_batch(
-                self._build_write(write_characteristic_uuid, [*value], wait_response=False, timeout_ms=self.timeout_ms),
-                self._build_read(RESULT_UUID, timeout_ms=self.timeout_ms)
-            ),
-            parallelism=16
+    def _build_write_result_batch(self, write_characteristic_uuid: str, value):
+        if write_characteristic_uuid == DATA_BUNDLE_UUID:
+            EXPANDER_BYTES.labels(characteristic='DATA_BUNDLE').inc(len(value))
+        return self._write_result_batch_template(write_characteristic_uuid).render(
+            [value], timeout_ms=self.timeout_ms
         )
-        response = self.client.write_read_peripheral_value(self.adapter_id, request)
-        batch = response.batch_responses[0]
+
+    def _check_write_result_batch(self, batch: PeripheralIoBatchResponseDto):
         self._validate_batch(batch)
         command_id = self._interpret_response(batch.command_responses[1])
 
@@ -119,6 +194,96 @@ class Expander:
 
         return batch
 
+    def _build_write_read_request(self, write_characteristic_uuid: str, value):
+        return self._build_encoded_request(
+            [self._build_write_result_batch(write_characteristic_uuid, value)],
+            parallelism=16,
+            writes=(write_characteristic_uuid,),
+        )
+
+    def _parse_write_read_response(self, response: PeripheralIoResponseDto):
+        return self._check_write_result_batch(response.batch_responses[0])
+
+    @staticmethod
+    def _miso_payload(batch: PeripheralIoBatchResponseDto) -> bytes:
+        Expander._validate_batch(batch)
+        payload = bytes(batch.command_responses[0].Ok)
+        EXPANDER_BYTES.labels(characteristic='MISO').inc(len(payload))
+        return payload
+
+    def _build_miso_batch(self):
+        return self._read_batch_template(MISO_UUID).render(timeout_ms=self.timeout_ms)
+
+    def _build_transaction_request(self, bundle: bytearray):
+        # The write and the RESULT notification must run concurrently within the first batch;
+        # request parallelism=1 keeps the MISO batch behind it.
+        return self._build_encoded_request(
+            [self._build_write_result_batch(DATA_BUNDLE_UUID, bundle), self._build_miso_batch()],
+            parallelism=1,
+            writes=(DATA_BUNDLE_UUID,),
+        )
+
+    def _parse_transaction_response(self, response: PeripheralIoResponseDto):
+        bundle_batch, miso_batch = response.batch_responses
+        self._check_write_result_batch(bundle_batch)
+        return self._miso_payload(miso_batch)
+
+    def _build_rdwr_request(self, messages):
+        """
+        Compiles i2c messages into one request: a bundle/RESULT batch per message followed by a MISO batch
+        for every read, executed in order.
+        """
+        batches = []
+        for message in messages:
+            match message:
+                case WriteMessage(address, buf):
+                    batches.append(self._build_write_result_batch(DATA_BUNDLE_UUID, self._write_bundle(address, buf)))
+                case ReadMessage(address=address, size=size):
+                    batches.append(self._build_write_result_batch(DATA_BUNDLE_UUID, self._read_bundle(address, size)))
+                    batches.append(self._build_miso_batch())
+                case _:
+                    raise TypeError(f'Unsupported i2c message: {message!r}')
+        return self._build_encoded_request(batches, parallelism=1, writes=(DATA_BUNDLE_UUID,))
+
+    def _parse_rdwr_response(self, messages, response: PeripheralIoResponseDto):
+        batch_responses = iter(response.batch_responses)
+        for message in messages:
+            self._check_write_result_batch(next(batch_responses))
+            match message:
+                case WriteMessage(address, buf):
+                    logger.info("Wrote {} bytes to address {}", len(buf), address)
+                case ReadMessage(address=address, size=size):
+                    message.buf = memoryview(self._miso_payload(next(batch_responses)))[:size]
+                    logger.info("Read {} bytes from address {}: {}", size, address, message.buf.hex())
+
+    def _client_read(self, characteristic_uuid: str):
+        request = self._build_read_request(characteristic_uuid)
+        with _observe('read', characteristic_uuid):
+            response = self.client.write_read_peripheral_value(self.adapter_id, request)
+        return self._parse_read_response(response)
+
+    def _client_write_read(self, write_characteristic_uuid: str, value):
+        request = self._build_write_read_request(write_characteristic_uuid, value)
+        with _observe('write_read', write_characteristic_uuid):
+            response = self.client.write_read_peripheral_value(self.adapter_id, request)
+        return self._parse_write_read_response(response)
+
+    def _client_transaction(self, bundle: bytearray):
+        with self._span('Expander.transaction', mosi_bytes=len(bundle)) as s:
+            if not self.fused:
+                self.set_bundle(bundle)
+                payload = self.read_miso()
+            else:
+                request = self._build_transaction_request(bundle)
+                with _observe('transaction', DATA_BUNDLE_UUID):
+                    response = self.client.write_read_peripheral_value(self.adapter_id, request)
+                payload = self._parse_transaction_response(response)
+            s.set(miso_bytes=len(payload))
+            return payload
+
+    def _span(self, name: str, **attrs):
+        return span(name, peripheral=self.peripheral_address, power_wait=self.power_wait, **attrs)
+
     @staticmethod
     def _validate_batch(batch: PeripheralIoBatchResponseDto):
         for response in batch.command_responses:
@@ -144,15 +309,21 @@ class Expander:
 
         is_success = result_code >= 0
         if not is_success:
+            EXPANDER_ERRORS.labels(command=ID_NAME_MAP.get(command_id, 'UNKNOWN')).inc()
             raise ExpanderError.from_command_id(command_id)
 
         return command_id
 
     def set_bundle(self, data: bytearray):
-        self._client_write_read(DATA_BUNDLE_UUID, data)
+        with self._span('Expander.set_bundle', mosi_bytes=len(data)):
+            self._client_write_read(DATA_BUNDLE_UUID, data)
 
     def read_miso(self):
-        return self._client_read(MISO_UUID)
+        with self._span('Expander.read_miso') as s:
+            payload = bytes(self._client_read(MISO_UUID))
+            EXPANDER_BYTES.labels(characteristic='MISO').inc(len(payload))
+            s.set(miso_bytes=len(payload))
+            return payload
 
     def set_cs(self, cs: int):
         self._client_write_read(CS_UUID, cs.to_bytes(1, 'little', signed=False))
@@ -163,58 +334,171 @@ class Expander:
     def set_power(self, on: bool):
         self._client_write_read(POWER_UUID, on.to_bytes(1, 'little', signed=False))
 
-    def xfer(self, buf: bytearray, *args, **kwargs):
+    def _xfer_bundle(self, buf: bytearray):
         """
         0x00 => Ok(Command::Write),
         0x01 => Ok(Command::Read),
         0x02 => Ok(Command::Transfer),
         """
-
-        bundle = pack_data_bundle(
+        return pack_data_bundle(
             lock=1, power=True, command=2, size_write=len(buf), mosi=buf,
             power_wait=self.power_wait
         )
-        self.set_bundle(bundle)
-        return self.read_miso()
 
-    def scan_i2c(self):
-        bundle = pack_data_bundle(
-            lock=2, power=True, command=3, address=0, size_write=0, mosi=bytearray(),
+    def _scan_i2c_bundle(self):
+        return pack_data_bundle(
+            lock=2, power=True, command=3, address=0, size_write=0, mosi=b'',
             power_wait=self.power_wait
         )
-        self.set_bundle(bundle)
-        return [address for address in self.read_miso() if address != 0]
 
-    def write(self, address: int, buf: bytearray):
-        bundle = pack_data_bundle(
+    def _write_bundle(self, address: int, buf: bytearray):
+        return pack_data_bundle(
             lock=2, power=True, command=0, address=address, size_write=len(buf), mosi=buf,
             power_wait=self.power_wait
         )
-        return self.set_bundle(bundle)
 
-    def read(self, address: int, size: int):
-        bundle = pack_data_bundle(
+    @staticmethod
+    def _read_bundle(address: int, size: int):
+        return pack_data_bundle(
             lock=2, power=True, command=1, address=address, size_read=size
         )
-        self.set_bundle(bundle)
-        result = self.read_miso()
-        return result[:size]
 
-    def write_read(self, address: int, buf: bytearray, size_read: int):
-        bundle = pack_data_bundle(
+    @staticmethod
+    def _write_read_bundle(address: int, buf: bytearray, size_read: int):
+        return pack_data_bundle(
             lock=2, power=True, command=2, address=address, size_write=len(buf), size_read=size_read, mosi=buf)
-        self.set_bundle(bundle)
-        return self.read_miso()[:size_read]
 
-    def i2c_rdwr(self, *messages):
-        for message in messages:
-            match message:
-                case WriteMessage(address, buf):
-                    self.write(address, buf)
-                    logger.info("Wrote {} bytes to address {}", len(buf), address)
-                case ReadMessage(address=address, size=size):
-                    result = self.read(address, size)
-                    message.buf = result
-                    logger.info("Read {} bytes from address {}: {}", size, address, result)
+    def xfer(self, buf: bytearray, *args, **kwargs):
+        return self._client_transaction(self._xfer_bundle(buf))
 
+    def scan_i2c(self):
+        key = i2c_key(self.peripheral_address, None, 'scan_i2c')
+        if self.cache is not None and (addresses := self.cache.get(key)) is not None:
+            return list(addresses)
+        addresses = [address for address in self._client_transaction(self._scan_i2c_bundle()) if address != 0]
+        if self.cache is not None:
+            self.cache.put(key, tuple(addresses), self.scan_i2c_ttl)
+        return addresses
+
+    def write(self, address: int, buf: bytearray):
+        return self.set_bundle(self._write_bundle(address, buf))
+
+    def read(self, address: int, size: int):
+        result = self._client_transaction(self._read_bundle(address, size))
+        return memoryview(result)[:size]
+
+    def write_read(self, address: int, buf: bytearray, size_read: int):
+        return memoryview(self._client_transaction(self._write_read_bundle(address, buf, size_read)))[:size_read]
 
+    def i2c_rdwr(self, *messages):
+        with self._span('Expander.i2c_rdwr', messages=len(messages)):
+            if self.fused:
+                request = self._build_rdwr_request(messages)
+                with _observe('rdwr', DATA_BUNDLE_UUID):
+                    response = self.client.write_read_peripheral_value(self.adapter_id, request)
+                self._parse_rdwr_response(messages, response)
+                return
+
+            for message in messages:
+                match message:
+                    case WriteMessage(address, buf):
+                        self.write(address, buf)
+                        logger.info("Wrote {} bytes to address {}", len(buf), address)
+                    case ReadMessage(address=address, size=size):
+                        result = self.read(address, size)
+                        message.buf = result
+                        logger.info("Read {} bytes from address {}: {}", size, address, result.hex())
+
+
+class AsyncExpander(Expander):
+    """
+    `Expander` driven by an `AsyncBleCollectorClient`; every I/O method is a coroutine.
+    """
+    client: 'AsyncBleCollectorClient'
+
+    async def _client_read(self, characteristic_uuid: str):
+        request = self._build_read_request(characteristic_uuid)
+        with _observe('read', characteristic_uuid):
+            response = await self.client.write_read_peripheral_value(self.adapter_id, request)
+        return self._parse_read_response(response)
+
+    async def _client_write_read(self, write_characteristic_uuid: str, value):
+        request = self._build_write_read_request(write_characteristic_uuid, value)
+        with _observe('write_read', write_characteristic_uuid):
+            response = await self.client.write_read_peripheral_value(self.adapter_id, request)
+        return self._parse_write_read_response(response)
+
+    async def _client_transaction(self, bundle: bytearray):
+        with self._span('Expander.transaction', mosi_bytes=len(bundle)) as s:
+            if not self.fused:
+                await self.set_bundle(bundle)
+                payload = await self.read_miso()
+            else:
+                request = self._build_transaction_request(bundle)
+                with _observe('transaction', DATA_BUNDLE_UUID):
+                    response = await self.client.write_read_peripheral_value(self.adapter_id, request)
+                payload = self._parse_transaction_response(response)
+            s.set(miso_bytes=len(payload))
+            return payload
+
+    async def set_bundle(self, data: bytearray):
+        with self._span('Expander.set_bundle', mosi_bytes=len(data)):
+            await self._client_write_read(DATA_BUNDLE_UUID, data)
+
+    async def read_miso(self):
+        with self._span('Expander.read_miso') as s:
+            payload = bytes(await self._client_read(MISO_UUID))
+            EXPANDER_BYTES.labels(characteristic='MISO').inc(len(payload))
+            s.set(miso_bytes=len(payload))
+            return payload
+
+    async def set_cs(self, cs: int):
+        await self._client_write_read(CS_UUID, cs.to_bytes(1, 'little', signed=False))
+
+    async def set_lock(self, lock_type: int):
+        await self._client_write_read(LOCK_UUID, lock_type.to_bytes(1, 'little', signed=False))
+
+    async def set_power(self, on: bool):
+        await self._client_write_read(POWER_UUID, on.to_bytes(1, 'little', signed=False))
+
+    async def xfer(self, buf: bytearray, *args, **kwargs):
+        return await self._client_transaction(self._xfer_bundle(buf))
+
+    async def scan_i2c(self):
+        key = i2c_key(self.peripheral_address, None, 'scan_i2c')
+        if self.cache is not None and (addresses := self.cache.get(key)) is not None:
+            return list(addresses)
+        addresses = [address for address in await self._client_transaction(self._scan_i2c_bundle()) if address != 0]
+        if self.cache is not None:
+            self.cache.put(key, tuple(addresses), self.scan_i2c_ttl)
+        return addresses
+
+    async def write(self, address: int, buf: bytearray):
+        return await self.set_bundle(self._write_bundle(address, buf))
+
+    async def read(self, address: int, size: int):
+        result = await self._client_transaction(self._read_bundle(address, size))
+        return memoryview(result)[:size]
+
+    async def write_read(self, address: int, buf: bytearray, size_read: int):
+        result = await self._client_transaction(self._write_read_bundle(address, buf, size_read))
+        return memoryview(result)[:size_read]
+
+    async def i2c_rdwr(self, *messages):
+        with self._span('Expander.i2c_rdwr', messages=len(messages)):
+            if self.fused:
+                request = self._build_rdwr_request(messages)
+                with _observe('rdwr', DATA_BUNDLE_UUID):
+                    response = await self.client.write_read_peripheral_value(self.adapter_id, request)
+                self._parse_rdwr_response(messages, response)
+                return
+
+            for message in messages:
+                match message:
+                    case WriteMessage(address, buf):
+                        await self.write(address, buf)
+                        logger.info("Wrote {} bytes to address {}", len(buf), address)
+                    case ReadMessage(address=address, size=size):
+                        result = await self.read(address, size)
+                        message.buf = result
+                        logger.info("Read {} bytes from address {}: {}", size, address, result.hex())
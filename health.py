@@ -0,0 +1,325 @@
+"""
+Per-peripheral circuit breakers.
+
+A peripheral's circuit opens after `failure_threshold` consecutive requests in which none of its commands got an
+answer. While it is open, requests that only touch open peripherals fail at once with `CircuitOpenError` and the
+scheduler skips the peripheral's jobs. When the cool-down runs out the circuit is half-open: the next job first
+runs a cheap probe, which closes the circuit or reopens it with a doubled cool-down. Peripherals that cannot be
+probed get a single trial job instead, whose requests decide the same way.
+"""
+import enum
+import threading
+import time
+from typing import Callable, Optional, Iterable
+
+from loguru import logger
+
+from bme_calibrator_service import BME280_SERVICE, TEMPERATURE_CH
+from codec import EncodedIoRequest, request_peripherals, request_batch_peripherals, command_peripheral
+from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoRequestDto, PeripheralIoResponseDto
+from expander import Expander, RESULT_UUID
+from metrics import CIRCUITS, CIRCUIT_TRANSITIONS, CIRCUIT_FAST_FAILURES
+
+
+class CircuitState(enum.Enum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, peripherals: tuple[str, ...], retry_in: float):
+        super().__init__(f'Circuit of {", ".join(peripherals)} is open, retrying in {retry_in:.1f}s')
+        self.peripherals = peripherals
+        self.retry_in = retry_in
+
+
+class _Circuit:
+    __slots__ = ('state', 'failures', 'cooldown', 'retry_at', 'probing', 'trial_thread')
+
+    def __init__(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.cooldown = 0.0
+        self.retry_at = 0.0
+        # a probe, or a job standing in for one, is deciding the half-open circuit
+        self.probing = False
+        self.trial_thread: Optional[int] = None
+
+
+class HealthTracker:
+    """
+    :param failure_threshold: consecutive failures that open a closed circuit
+    :param cooldown: seconds the circuit stays open the first time; doubled by every failed probe
+    :param max_cooldown: cap of the cool-down
+    :param probe: `probe(peripheral) -> Optional[bool]`, a cheap reachability check run when the circuit is
+        half-open; None means the peripheral cannot be probed. Without a probe result the next job is the
+        trial: it runs alone, and the outcome of its requests closes or reopens the circuit
+    """
+
+    def __init__(
+            self,
+            failure_threshold: int = 3,
+            cooldown: float = 10.0,
+            max_cooldown: float = 600.0,
+            probe: Optional[Callable[[str], Optional[bool]]] = None,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe = probe
+        self.clock = clock
+        self._circuits: dict[str, _Circuit] = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, peripheral: str, create: bool = False) -> Optional[_Circuit]:
+        """
+        Circuits only exist for peripherals that failed since their last success; the others are closed.
+        """
+        circuit = self._circuits.get(peripheral)
+        if circuit is None:
+            if not create:
+                return None
+            circuit = self._circuits[peripheral] = _Circuit()
+            CIRCUITS.labels(state=circuit.state.name.lower()).inc()
+        if circuit.state is CircuitState.OPEN and self.clock() >= circuit.retry_at:
+            self._transition(circuit, CircuitState.HALF_OPEN)
+        return circuit
+
+    @staticmethod
+    def _transition(circuit: _Circuit, state: CircuitState):
+        CIRCUITS.labels(state=circuit.state.name.lower()).dec()
+        CIRCUITS.labels(state=state.name.lower()).inc()
+        circuit.state = state
+        circuit.probing = False
+        circuit.trial_thread = None
+        CIRCUIT_TRANSITIONS.labels(state=state.name.lower()).inc()
+
+    def forget(self, peripheral: str):
+        """
+        Drops the circuit of a peripheral that left the fleet.
+        """
+        with self._lock:
+            circuit = self._circuits.pop(peripheral, None)
+            if circuit is not None:
+                CIRCUITS.labels(state=circuit.state.name.lower()).dec()
+
+    def state(self, peripheral: str) -> CircuitState:
+        with self._lock:
+            circuit = self._circuit(peripheral)
+            return CircuitState.CLOSED if circuit is None else circuit.state
+
+    def is_open(self, peripheral: str) -> bool:
+        return self.state(peripheral) is CircuitState.OPEN
+
+    def retry_in(self, peripheral: str) -> float:
+        with self._lock:
+            circuit = self._circuit(peripheral)
+            return 0.0 if circuit is None else max(0.0, circuit.retry_at - self.clock())
+
+    def record_success(self, peripheral: str):
+        with self._lock:
+            circuit = self._circuit(peripheral)
+            if circuit is None:
+                return
+            if circuit.state is not CircuitState.CLOSED:
+                logger.info(f'[{peripheral}] Circuit closed')
+                self._transition(circuit, CircuitState.CLOSED)
+            # a closed circuit without failures is the same as none
+            del self._circuits[peripheral]
+            CIRCUITS.labels(state=circuit.state.name.lower()).dec()
+
+    def record_failure(self, peripheral: str):
+        with self._lock:
+            circuit = self._circuit(peripheral, create=True)
+            circuit.failures += 1
+            if circuit.state is CircuitState.HALF_OPEN:
+                circuit.cooldown = min(circuit.cooldown * 2, self.max_cooldown)
+            elif circuit.state is CircuitState.CLOSED and circuit.failures >= self.failure_threshold:
+                circuit.cooldown = self.cooldown
+            else:
+                return
+            circuit.retry_at = self.clock() + circuit.cooldown
+            logger.warning(
+                f'[{peripheral}] Circuit open after {circuit.failures} failures, retrying in {circuit.cooldown:.1f}s'
+            )
+            self._transition(circuit, CircuitState.OPEN)
+
+    def record_failures(self, peripherals: Iterable[str]):
+        for peripheral in peripherals:
+            self.record_failure(peripheral)
+
+    def check(self, peripherals: Iterable[str]):
+        """
+        Raises `CircuitOpenError` if every one of `peripherals` has an open circuit.
+        """
+        peripherals = tuple(peripherals)
+        if peripherals and all(self.is_open(peripheral) for peripheral in peripherals):
+            CIRCUIT_FAST_FAILURES.inc()
+            raise CircuitOpenError(peripherals, min(self.retry_in(peripheral) for peripheral in peripherals))
+
+    def admit(self, peripheral: str) -> bool:
+        """
+        Whether work for `peripheral` should run now; runs the probe when the circuit is half-open.
+
+        If the probe cannot decide, the calling thread's job becomes the trial; call `end_trial` when it is done.
+        """
+        with self._lock:
+            circuit = self._circuit(peripheral)
+            if circuit is None or circuit.state is CircuitState.CLOSED:
+                return True
+            if circuit.state is CircuitState.OPEN or circuit.probing:
+                return False
+            circuit.probing = True
+
+        reachable = None
+        if self.probe is not None:
+            try:
+                reachable = self.probe(peripheral)
+            except Exception as e:
+                logger.warning(f'[{peripheral}] Probe failed: {e}')
+                reachable = False
+
+        if reachable is None:
+            with self._lock:
+                if circuit.state is not CircuitState.HALF_OPEN or not circuit.probing:
+                    return False
+                circuit.trial_thread = threading.get_ident()
+            return True
+
+        if reachable:
+            self.record_success(peripheral)
+        else:
+            self.record_failure(peripheral)
+        with self._lock:
+            circuit.probing = False
+        return reachable
+
+    def end_trial(self, peripheral: str):
+        """
+        Lets the next job try a half-open circuit if the calling thread's trial job recorded no outcome.
+        """
+        with self._lock:
+            circuit = self._circuits.get(peripheral)
+            if circuit is not None and circuit.trial_thread == threading.get_ident():
+                circuit.probing = False
+                circuit.trial_thread = None
+
+    def record_response(self, io_request: PeripheralIoRequestDto | EncodedIoRequest, response: PeripheralIoResponseDto):
+        """
+        A peripheral failed if none of its commands got an answer. Encoded requests that do not tell which
+        peripheral every batch talks to (`EncodedIoRequest.batch_peripherals`) are not recorded.
+        """
+        answered = {}
+        for peripherals, batch_response in zip(request_batch_peripherals(io_request), response.batch_responses):
+            for index, command_response in enumerate(batch_response.command_responses):
+                peripheral = command_peripheral(peripherals, index)
+                ok = command_response is not None and command_response.Error is None
+                answered[peripheral] = answered.get(peripheral, False) or ok
+
+        for peripheral, ok in answered.items():
+            if ok:
+                self.record_success(peripheral)
+            else:
+                self.record_failure(peripheral)
+
+
+# characteristics that can be read without side effects, by service
+PROBE_CHARACTERISTICS = {
+    Expander.SERVICE_UUID: RESULT_UUID,
+    BME280_SERVICE: TEMPERATURE_CH,
+}
+
+
+class ReadProbe:
+    """
+    Probes a peripheral with a single plain read of a known characteristic, see `PROBE_CHARACTERISTICS`.
+    Returns None for peripherals without one, so their next job becomes the trial.
+    """
+
+    def __init__(self, client, topology, timeout_ms: int = 2000):
+        self.client = client
+        self.topology = topology
+        self.timeout_ms = timeout_ms
+
+    def __call__(self, peripheral: str) -> Optional[bool]:
+        adapter_id = self.topology.adapter_of(peripheral)
+        if adapter_id is None:
+            return False
+        services = self.topology.services(peripheral)
+        for service, characteristic in PROBE_CHARACTERISTICS.items():
+            if characteristic in services.get(service, ()):
+                break
+        else:
+            return None
+
+        request = PeripheralIoRequestDto(batches=[PeripheralIoBatchRequestDto(commands=[
+            IoCommand.read(
+                fqcn=Fqcn(peripheral=peripheral, service=service, characteristic=characteristic),
+                wait_notification=False,
+                timeout_ms=self.timeout_ms,
+            )
+        ], parallelism=1)], parallelism=1)
+        command = self.client.write_read_peripheral_value(adapter_id, request).batch_responses[0].command_responses[0]
+        return command is not None and command.Error is None
+
+
+class CircuitBreakerClient:
+    """
+    Fails requests whose peripherals all have open circuits without sending them, and feeds the outcome of every
+    other request to the `HealthTracker`. A request that raises, e.g. an HTTP timeout, counts as a failure of
+    its peripheral only if it has a single one: a collector hiccup says nothing about a whole fleet.
+    """
+
+    def __init__(self, client, health: HealthTracker):
+        self.client = client
+        self.health = health
+
+    def list_adapters(self):
+        return self.client.list_adapters()
+
+    def describe_adapters(self):
+        return self.client.describe_adapters()
+
+    def write_read_peripheral_value(self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest):
+        peripherals = request_peripherals(io_request)
+        self.health.check(peripherals)
+        try:
+            response = self.client.write_read_peripheral_value(adapter_id, io_request)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            if len(peripherals) == 1:
+                self.health.record_failure(peripherals[0])
+            raise
+        self.health.record_response(io_request, response)
+        return response
+
+
+class AsyncCircuitBreakerClient(CircuitBreakerClient):
+    """
+    `CircuitBreakerClient` over an `AsyncBleCollectorClient`.
+    """
+
+    async def list_adapters(self):
+        return await self.client.list_adapters()
+
+    async def describe_adapters(self):
+        return await self.client.describe_adapters()
+
+    async def write_read_peripheral_value(
+            self, adapter_id: str, io_request: PeripheralIoRequestDto | EncodedIoRequest
+    ):
+        peripherals = request_peripherals(io_request)
+        self.health.check(peripherals)
+        try:
+            response = await self.client.write_read_peripheral_value(adapter_id, io_request)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            if len(peripherals) == 1:
+                self.health.record_failure(peripherals[0])
+            raise
+        self.health.record_response(io_request, response)
+        return response
@@ -1,31 +1,110 @@
+import atexit
 import os
-from time import sleep
+import signal
+import sys
+from functools import partial
 
 from prometheus_client import start_http_server
 
+from admission import AdmissionControlClient
 from ble_collector_client import BleCollectorClient
-from routines import set_timeout, read_scd41
+from cache import CachingClient, ReadCache
+from coalescer import CoalescingClient
+from discovery import FleetDiscovery
+from health import HealthTracker, CircuitBreakerClient, ReadProbe
+from routines import build_device_jobs, forget_device
+from scheduler import Scheduler, Job
+from telemetry import Bme280TelemetryReader, Bme280NotificationFollower
+from topology import TopologyCache
+from tracing import set_tracer, Tracer, JsonLinesExporter, FoldedStackExporter
+
+
+def dump_folded(folded: FoldedStackExporter, path: str):
+    with open(path, 'w') as stream:
+        folded.dump(stream)
+
+
+def configure_tracing():
+    exporters = []
+    if jsonl_path := os.environ.get('TRACE_JSONL'):
+        exporters.append(JsonLinesExporter(open(jsonl_path, 'a', buffering=1)))
+    if folded_path := os.environ.get('TRACE_FOLDED'):
+        folded = FoldedStackExporter()
+        exporters.append(folded)
+        atexit.register(dump_folded, folded, folded_path)
+        # SIGTERM would skip atexit
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if exporters:
+        set_tracer(Tracer(*exporters))
 
-PERIPHERALS = [
-    'D0:F6:3B:34:4C:1F',
-    'D4:B7:67:56:DC:3B',
-    'FA:6F:EC:EE:4B:36',
-]
 
 if __name__ == '__main__':
     start_http_server(12500)
+    configure_tracing()
     collector_address = os.environ.get('COLLECTOR_ADDRESS', 'http://127.0.0.1:9090')
-    adapter_id = os.environ.get('ADAPTER', 'hci0')
+    workers = int(os.environ.get('WORKERS_PER_ADAPTER', '4'))
+    discovery_interval = float(os.environ.get('DISCOVERY_INTERVAL', '60'))
+    telemetry_interval = float(os.environ.get('TELEMETRY_INTERVAL', '60'))
 
-    client = BleCollectorClient(address=collector_address)
-    set_timeout(client, adapter_id, PERIPHERALS, 60000)
+    admitted = AdmissionControlClient(
+        CoalescingClient(BleCollectorClient(address=collector_address)),
+        max_in_flight=int(os.environ.get('MAX_IN_FLIGHT', '4')),
+    )
+    topology = TopologyCache(admitted, ttl=discovery_interval)
+    health = HealthTracker(
+        failure_threshold=int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '3')),
+        cooldown=float(os.environ.get('CIRCUIT_COOLDOWN', '30')),
+        max_cooldown=float(os.environ.get('CIRCUIT_MAX_COOLDOWN', '900')),
+        probe=ReadProbe(admitted, topology),
+    )
+    # cache hits skip the circuit breaker, admission control and coalescing altogether;
+    # requests to dead peripherals fail before they take an admission slot
+    client = CachingClient(
+        CircuitBreakerClient(admitted, health),
+        ReadCache(maxsize=int(os.environ.get('READ_CACHE_SIZE', '4096'))),
+    )
+    scheduler = Scheduler(workers_per_adapter=workers, health=health)
+    discovery = FleetDiscovery(
+        client, scheduler, topology, partial(build_device_jobs, client, topology, health=health),
+        on_deregister=partial(forget_device, health=health),
+    )
 
-    counter = 0
-    while True:
-        if counter % 5 == 0:
-            set_timeout(client, adapter_id, PERIPHERALS, 60000)
+    scheduler.add(Job(
+        name='discovery',
+        adapter_id='discovery',
+        fn=discovery.poll,
+        interval=discovery_interval,
+    ), delay=0)
 
-        read_scd41(client, adapter_id, 'FA:6F:EC:EE:4B:36')
-        sleep(60)
+    if os.environ.get('TELEMETRY_MODE', 'poll') == 'notify':
+        # long-polls get their own connection pool and admission budget, so they cannot starve the polling jobs,
+        # and skip coalescing; every subscription holds a slot of the budget for the whole window
+        follower = Bme280NotificationFollower(
+            CircuitBreakerClient(
+                AdmissionControlClient(
+                    BleCollectorClient(address=collector_address),
+                    max_in_flight=int(os.environ.get('NOTIFY_MAX_IN_FLIGHT', '64')),
+                ),
+                health,
+            ),
+            topology,
+            window_ms=int(telemetry_interval * 1000),
+            health=health,
+        )
+        scheduler.add(Job(
+            name='bme280-notifications',
+            adapter_id='telemetry',
+            fn=follower.sync,
+            interval=discovery_interval,
+        ))
+    else:
+        telemetry = Bme280TelemetryReader(client, health=health)
+        scheduler.add(Job(
+            name='bme280-telemetry',
+            adapter_id='telemetry',
+            fn=lambda: telemetry.poll_fleet(topology),
+            interval=telemetry_interval,
+            deadline=telemetry_interval,
+        ))
 
-        counter += 1
+    scheduler.run_forever()
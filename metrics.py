@@ -1,5 +1,72 @@
-from prometheus_client import Gauge
+from prometheus_client import Gauge, Histogram, Counter
 
 CO2 = Gauge('sensor_hub_scd41_co2_ppm', 'CO2', ['peripheral', 'scope'])
 HUMIDITY = Gauge('sensor_hub_scd41_humidity_percent', 'Humidity', ['peripheral', 'scope'])
 TEMPERATURE = Gauge('sensor_hub_scd41_temperature_degrees_celsius', 'Temperature', ['peripheral', 'scope'])
+
+# Instrumentation of the I/O path. Labels take values from small fixed sets (endpoint names, characteristic
+# names, adapter ids) and never a peripheral address, so cardinality does not grow with the fleet.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+COLLECTOR_REQUEST_SECONDS = Histogram(
+    'sensor_hub_collector_request_seconds', 'Collector HTTP request latency',
+    ['endpoint', 'status'], buckets=LATENCY_BUCKETS,
+)
+COLLECTOR_RETRIES = Counter(
+    'sensor_hub_collector_retries_total', 'Collector HTTP requests retried after a connection error',
+    ['endpoint'],
+)
+
+BLE_COMMAND_SECONDS = Histogram(
+    'sensor_hub_ble_command_seconds', 'Round trip of an Expander request/response pair',
+    ['operation', 'characteristic'], buckets=LATENCY_BUCKETS,
+)
+EXPANDER_ERRORS = Counter(
+    'sensor_hub_expander_errors_total', 'Expander commands that returned a failure result code',
+    ['command'],
+)
+EXPANDER_BYTES = Counter(
+    'sensor_hub_expander_bytes_total', 'Bytes moved through the Expander DATA_BUNDLE and MISO characteristics',
+    ['characteristic'],
+)
+
+SCHEDULER_LAG_SECONDS = Histogram(
+    'sensor_hub_scheduler_lag_seconds', 'Delay between a job slot and the moment a worker started it',
+    ['adapter'], buckets=LATENCY_BUCKETS,
+)
+SCHEDULER_RUN_SECONDS = Histogram(
+    'sensor_hub_scheduler_run_seconds', 'Job run time',
+    ['adapter'], buckets=LATENCY_BUCKETS,
+)
+SCHEDULER_SKIPPED = Counter(
+    'sensor_hub_scheduler_skipped_total', 'Job slots that were skipped',
+    ['adapter', 'reason'],
+)
+SCHEDULER_QUEUE_DEPTH = Gauge('sensor_hub_scheduler_queue_depth', 'Job slots waiting in the scheduler heap')
+SCHEDULER_IN_FLIGHT = Gauge(
+    'sensor_hub_scheduler_in_flight', 'Jobs submitted to an adapter worker pool and not finished yet',
+    ['adapter'],
+)
+
+BME280_TEMPERATURE = Gauge('sensor_hub_bme280_temperature_degrees_celsius', 'Temperature', ['peripheral'])
+BME280_PRESSURE = Gauge('sensor_hub_bme280_pressure_pascals', 'Pressure', ['peripheral'])
+BME280_HUMIDITY = Gauge('sensor_hub_bme280_humidity_percent', 'Humidity', ['peripheral'])
+BME280_READ_FAILURES = Counter(
+    'sensor_hub_bme280_read_failures_total', 'BME280 characteristic reads that returned no value', ['quantity'],
+)
+
+READ_CACHE_REQUESTS = Counter(
+    'sensor_hub_read_cache_requests_total', 'Read cache lookups by key kind (fqcn, i2c) and result',
+    ['kind', 'result'],
+)
+
+CIRCUITS = Gauge(
+    'sensor_hub_circuits', 'Circuit breakers of peripherals that failed since their last success, by state', ['state'],
+)
+CIRCUIT_TRANSITIONS = Counter(
+    'sensor_hub_circuit_transitions_total', 'Peripheral circuit breaker state changes by target state', ['state'],
+)
+CIRCUIT_FAST_FAILURES = Counter(
+    'sensor_hub_circuit_fast_failures_total', 'Requests rejected without BLE I/O because their circuit was open',
+)
@@ -0,0 +1,187 @@
+"""
+Notification subscriptions on top of the collector `/io` endpoint.
+
+The collector has no push channel, so a stream long-polls: every cycle is one request with a
+`wait_notification` read per subscribed characteristic, each waiting up to `window_ms`. A characteristic yields
+at most one sample per cycle, and a notification that fires between two cycles is missed, so the window should
+be close to the notification period of the peripherals.
+"""
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, AsyncIterator
+
+from loguru import logger
+
+from codec import EncodedIoRequest, encode_batch
+from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoResponseDto
+
+
+@dataclass(frozen=True)
+class Subscription:
+    peripheral: str
+    service: str
+    characteristic: str
+    # turns the raw value into a sample value; not part of the subscription identity
+    decode: Callable[[bytes], Any] = field(default=bytes, compare=False)
+
+
+@dataclass
+class Sample:
+    subscription: Subscription
+    value: Any
+    received_at: float
+
+
+class NotificationStream:
+    """
+    Iterating the stream yields `Sample`s as notifications arrive, until `close()` is called.
+    Subscriptions can be changed from other threads; they apply from the next cycle.
+    """
+
+    def __init__(
+            self,
+            client,
+            adapter_id: str,
+            subscriptions: Iterable[Subscription] = (),
+            window_ms: int = 10000,
+            parallelism: int = 64,
+            retry_delay: float = 1.0,
+    ):
+        self.client = client
+        self.adapter_id = adapter_id
+        self.window_ms = window_ms
+        self.parallelism = parallelism
+        self.retry_delay = retry_delay
+        self._subscriptions: dict[Subscription, None] = dict.fromkeys(subscriptions)
+        self._request: tuple[tuple[Subscription, ...], EncodedIoRequest] | None = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    @property
+    def subscriptions(self) -> tuple[Subscription, ...]:
+        with self._lock:
+            return tuple(self._subscriptions)
+
+    def subscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions[subscription] = None
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.pop(subscription, None)
+
+    def set_subscriptions(self, subscriptions: Iterable[Subscription]):
+        with self._lock:
+            self._subscriptions = dict.fromkeys(subscriptions)
+
+    def close(self):
+        self._closed.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def build_request(self) -> tuple[tuple[Subscription, ...], EncodedIoRequest | None]:
+        subscriptions = self.subscriptions
+        if not subscriptions:
+            return subscriptions, None
+        cached = self._request
+        if cached is not None and cached[0] == subscriptions:
+            return cached
+
+        batch = PeripheralIoBatchRequestDto(commands=[
+            IoCommand.read(
+                fqcn=Fqcn(
+                    peripheral=subscription.peripheral,
+                    service=subscription.service,
+                    characteristic=subscription.characteristic,
+                ),
+                wait_notification=True,
+                timeout_ms=self.window_ms,
+            )
+            for subscription in subscriptions
+        ], parallelism=min(self.parallelism, len(subscriptions)))
+        command_peripherals = tuple(subscription.peripheral for subscription in subscriptions)
+        self._request = subscriptions, EncodedIoRequest(
+            [encode_batch(batch)], 1, tuple(dict.fromkeys(command_peripherals)),
+            batch_peripherals=(command_peripherals,),
+        )
+        return self._request
+
+    @staticmethod
+    def parse(subscriptions: tuple[Subscription, ...], response: PeripheralIoResponseDto) -> list[Sample]:
+        received_at = time.time()
+        samples = []
+        for subscription, command in zip(subscriptions, response.batch_responses[0].command_responses):
+            if command is None or command.Error is not None:
+                # no notification within the window, or the peripheral is unreachable
+                continue
+            try:
+                value = subscription.decode(bytes(command.Ok))
+            except Exception as e:
+                logger.warning(f'[{subscription.peripheral}] Failed to decode {subscription.characteristic}: {e}')
+                continue
+            samples.append(Sample(subscription, value, received_at))
+        return samples
+
+    def poll(self) -> list[Sample]:
+        """
+        Runs one long-poll cycle; returns the samples that arrived within the window.
+        """
+        subscriptions, request = self.build_request()
+        if request is None:
+            self._closed.wait(self.window_ms / 1000)
+            return []
+        response = self.client.write_read_peripheral_value(self.adapter_id, request)
+        return self.parse(subscriptions, response)
+
+    def __iter__(self) -> Iterator[Sample]:
+        while not self.closed:
+            try:
+                samples = self.poll()
+            except Exception as e:
+                logger.warning(f'[{self.adapter_id}] Notification poll failed: {e}')
+                self._closed.wait(self.retry_delay)
+                continue
+            yield from samples
+
+    def run(self, sink: Callable[[Sample], Any]):
+        """
+        Feeds every sample to `sink` until the stream is closed.
+        """
+        for sample in self:
+            sink(sample)
+
+
+class AsyncNotificationStream(NotificationStream):
+    """
+    `NotificationStream` over an `AsyncBleCollectorClient`; iterate it with `async for`.
+    """
+
+    async def poll(self) -> list[Sample]:
+        subscriptions, request = self.build_request()
+        if request is None:
+            await asyncio.sleep(self.window_ms / 1000)
+            return []
+        response = await self.client.write_read_peripheral_value(self.adapter_id, request)
+        return self.parse(subscriptions, response)
+
+    def __iter__(self):
+        raise TypeError('Use async for with AsyncNotificationStream')
+
+    async def __aiter__(self) -> AsyncIterator[Sample]:
+        while not self.closed:
+            try:
+                samples = await self.poll()
+            except Exception as e:
+                logger.warning(f'[{self.adapter_id}] Notification poll failed: {e}')
+                await asyncio.sleep(self.retry_delay)
+                continue
+            for sample in samples:
+                yield sample
+
+    async def run(self, sink: Callable[[Sample], Any]):
+        async for sample in self:
+            sink(sample)
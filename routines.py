@@ -1,19 +1,37 @@
+from functools import partial
+from typing import Optional
+
 from loguru import logger
 
-from bme_calibrator_service import Bme280CalibratorService
-from contrib.scd import SCD4X
+from calibration import Bme280CalibrationEngine
+from contrib.scd import SCD4XSession, DEFAULT_I2C_ADDRESS as SCD4X_I2C_ADDRESS
+from discovery import Device, DeviceKind, TIMEOUT_SERVICES
 from expander import Expander
+from health import CircuitOpenError, HealthTracker
 from ble_timeout_setter_service import BleTimeoutSetter
 from metrics import *
+from scheduler import Job
+from topology import TopologyCache
+
+
+_scd41_sessions: dict[tuple[str, str], SCD4XSession] = {}
+
+
+def get_scd41_session(client, adapter, peripheral_address) -> SCD4XSession:
+    key = (adapter, peripheral_address)
+    session = _scd41_sessions.get(key)
+    if session is None or session.bus.client is not client:
+        expander_service = Expander(client, adapter, peripheral_address, timeout_ms=10000)
+        session = _scd41_sessions[key] = SCD4XSession(expander_service, quiet=False)
+    return session
 
 
 def read_scd41(client, adapter, peripheral_address):
-    expander_service = Expander(client, adapter, peripheral_address, timeout_ms=10000)
+    session = get_scd41_session(client, adapter, peripheral_address)
+    expander_service = session.bus
 
     try:
-        scd = SCD4X(expander_service, quiet=False)
-        scd.start_periodic_measurement()
-        co2, temperature, relative_humidity, _ = scd.measure(timeout=15)
+        co2, temperature, relative_humidity, _ = session.read(timeout=15)
 
         CO2.labels(peripheral=peripheral_address, scope='scd41').set(co2)
         TEMPERATURE.labels(peripheral=peripheral_address, scope='scd41').set(temperature)
@@ -21,28 +39,102 @@ def read_scd41(client, adapter, peripheral_address):
 
         logger.info(f'CO2: {co2} ppm, Temperature: {temperature} C, Humidity: {relative_humidity} %rH')
 
+    except CircuitOpenError as e:
+        logger.warning(f'Skipping SCD41 read: {e}')
     except Exception as e:
         logger.error(f'Failed to read Expander: {e}', exc_info=True)
     finally:
         try:
             expander_service.set_lock(0)
+        except CircuitOpenError:
+            pass
         except Exception as e:
             logger.error(f'Failed to release Expander lock: {e}', exc_info=True)
 
 
 def calibrate(client, adapter, peripherals):
-    service = Bme280CalibratorService(client, adapter)
-    result = service.calibrate_humidity_offset(
+    engine = Bme280CalibrationEngine(client, adapter)
+    result = engine.calibrate(
         peripherals,
         72.0, 102.4 * 1000, 21.9
     )
-    logger.info(f'Calibration result: {result}')
+    logger.info(f'Calibration result: {result.written}')
+
+
+_timeout_setters: dict[str, BleTimeoutSetter] = {}
+
 
+def get_timeout_setter(client, adapter, topology: Optional[TopologyCache] = None) -> BleTimeoutSetter:
+    service = _timeout_setters.get(adapter)
+    if service is None or service.client is not client or service.topology is not topology:
+        service = _timeout_setters[adapter] = BleTimeoutSetter(client, adapter, topology=topology)
+    return service
 
-def set_timeout(client, adapter, peripheral_address, timeout_ms):
+
+def set_timeout(client, adapter, peripheral_address, timeout_ms, topology: Optional[TopologyCache] = None):
     try:
-        service = BleTimeoutSetter(client, adapter)
-        result = service.set_all_timeouts(peripheral_address, timeout_ms)
+        service = get_timeout_setter(client, adapter, topology)
+        result = service.sync_all_timeouts(peripheral_address, timeout_ms)
         logger.info(f'Set timeout result: {result}')
     except Exception as e:
         logger.error(f'Failed to set timeout: {e}')
+
+
+def set_adapter_timeouts(
+        client, topology: TopologyCache, adapter, timeout_ms, health: Optional[HealthTracker] = None
+):
+    """
+    Syncs the notification timeouts of every peripheral on the adapter that has any, in one batched request.
+    Peripherals whose circuit is open are skipped.
+    """
+    peripherals = sorted({
+        peripheral
+        for service_uuid in TIMEOUT_SERVICES
+        for peripheral in topology.peripherals_with_service(service_uuid)
+        if topology.adapter_of(peripheral) == adapter and (health is None or not health.is_open(peripheral))
+    })
+    if peripherals:
+        set_timeout(client, adapter, peripherals, timeout_ms, topology)
+
+
+def forget_device(device: Device, health: Optional[HealthTracker] = None):
+    """
+    Drops the per-device state kept for the jobs of a deregistered device.
+    """
+    _scd41_sessions.pop((device.adapter_id, device.address), None)
+    if health is not None:
+        health.forget(device.address)
+    setter = _timeout_setters.get(device.adapter_id)
+    if setter is not None and not setter.forget(device.address):
+        _timeout_setters.pop(device.adapter_id, None)
+
+
+def build_device_jobs(
+        client,
+        topology: TopologyCache,
+        device: Device,
+        notification_timeout_ms: int = 60000,
+        health: Optional[HealthTracker] = None,
+) -> list[Job]:
+    jobs = []
+    if DeviceKind.NOTIFICATION_TIMEOUTS in device.kinds:
+        # shared by every device of the adapter, see `FleetDiscovery`
+        jobs.append(Job(
+            name=f'timeouts-{device.adapter_id}',
+            adapter_id=device.adapter_id,
+            fn=partial(set_adapter_timeouts, client, topology, device.adapter_id, notification_timeout_ms, health),
+            interval=300,
+            jitter=30,
+            deadline=60,
+        ))
+    if DeviceKind.EXPANDER in device.kinds and SCD4X_I2C_ADDRESS in (device.i2c_addresses or ()):
+        jobs.append(Job(
+            name=f'scd41-{device.address}',
+            adapter_id=device.adapter_id,
+            fn=partial(read_scd41, client, device.adapter_id, device.address),
+            interval=60,
+            jitter=5,
+            deadline=30,
+            peripheral=device.address,
+        ))
+    return jobs
@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Any, Optional
+
+import typing_extensions
+from loguru import logger
+
+from metrics import SCHEDULER_LAG_SECONDS, SCHEDULER_RUN_SECONDS, SCHEDULER_SKIPPED, SCHEDULER_QUEUE_DEPTH, \
+    SCHEDULER_IN_FLIGHT
+
+if typing_extensions.TYPE_CHECKING:
+    from health import HealthTracker
+
+
+@dataclass
+class Job:
+    name: str
+    adapter_id: str
+    fn: Callable[[], Any]
+    interval: float
+    # a random 0..jitter seconds is added to every run, spreading devices with the same interval
+    jitter: float = 0.0
+    # a run that cannot start within `deadline` seconds of its slot is skipped
+    deadline: Optional[float] = None
+    peripheral: Optional[str] = None
+
+    slot_at: float = field(default=0.0, init=False, repr=False)
+    next_run_at: float = field(default=0.0, init=False, repr=False)
+    running: bool = field(default=False, init=False, repr=False)
+    runs: int = field(default=0, init=False, repr=False)
+    skipped: int = field(default=0, init=False, repr=False)
+    failures: int = field(default=0, init=False, repr=False)
+
+
+class Scheduler:
+    """
+    Runs periodic jobs concurrently on a bounded worker pool per adapter.
+
+    A job never overlaps with itself: a slot that comes up while the previous run is still going is skipped,
+    as is a slot that could not start before its deadline. With `health`, slots of jobs whose peripheral has an
+    open circuit are skipped too.
+    """
+
+    def __init__(
+            self, workers_per_adapter: int = 4, clock: Callable[[], float] = time.monotonic,
+            health: Optional['HealthTracker'] = None,
+    ):
+        self.workers_per_adapter = workers_per_adapter
+        self.clock = clock
+        self.health = health
+        self.jobs: dict[str, Job] = {}
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._queue: list[tuple[float, int, Job]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, job: Job, delay: Optional[float] = None):
+        with self._condition:
+            if job.name in self.jobs:
+                raise ValueError(f'Job {job.name} is already scheduled')
+            self.jobs[job.name] = job
+            if delay is None:
+                self._push(job, self.clock(), random.uniform(0, job.jitter))
+            else:
+                self._push(job, self.clock() + delay)
+            self._condition.notify()
+        return job
+
+    def remove(self, name: str) -> Optional[Job]:
+        with self._condition:
+            # the stale heap entry is dropped when it comes up
+            return self.jobs.pop(name, None)
+
+    def _push(self, job: Job, slot_at: float, offset: float = 0.0):
+        job.slot_at = slot_at
+        job.next_run_at = slot_at + offset
+        heapq.heappush(self._queue, (job.next_run_at, next(self._sequence), job))
+        SCHEDULER_QUEUE_DEPTH.set(len(self._queue))
+
+    def _reschedule(self, job: Job, now: float):
+        slot_at = job.slot_at + job.interval
+        if slot_at < now:
+            # fell behind by more than one interval: drop the missed slots instead of bursting through them
+            slot_at = now + job.interval - (now - job.slot_at) % job.interval
+        self._push(job, slot_at, random.uniform(0, job.jitter))
+
+    def _executor(self, adapter_id: str) -> ThreadPoolExecutor:
+        executor = self._executors.get(adapter_id)
+        if executor is None:
+            executor = self._executors[adapter_id] = ThreadPoolExecutor(
+                max_workers=self.workers_per_adapter, thread_name_prefix=f'scheduler-{adapter_id}'
+            )
+        return executor
+
+    def _dispatch(self, job: Job, now: float):
+        if job.running:
+            job.skipped += 1
+            SCHEDULER_SKIPPED.labels(adapter=job.adapter_id, reason='overlap').inc()
+            logger.warning(f'Job {job.name} is still running, skipping its slot')
+        elif job.peripheral is not None and self.health is not None and self.health.is_open(job.peripheral):
+            job.skipped += 1
+            SCHEDULER_SKIPPED.labels(adapter=job.adapter_id, reason='circuit_open').inc()
+            logger.debug(f'Circuit of {job.peripheral} is open, skipping job {job.name}')
+        else:
+            job.running = True
+            SCHEDULER_IN_FLIGHT.labels(adapter=job.adapter_id).inc()
+            future = self._executor(job.adapter_id).submit(self._run, job, job.next_run_at)
+            future.add_done_callback(lambda _: self._finish(job))
+        self._reschedule(job, now)
+
+    def _run(self, job: Job, run_at: float):
+        started_at = self.clock()
+        lag = started_at - run_at
+        SCHEDULER_LAG_SECONDS.labels(adapter=job.adapter_id).observe(max(lag, 0.0))
+        if job.deadline is not None and lag > job.deadline:
+            # the adapter's workers were busy for too long
+            job.skipped += 1
+            SCHEDULER_SKIPPED.labels(adapter=job.adapter_id, reason='deadline').inc()
+            logger.warning(f'Job {job.name} missed its deadline by {lag - job.deadline:.3f}s, skipping')
+            return
+        if job.peripheral is not None and self.health is not None and not self.health.admit(job.peripheral):
+            # a half-open circuit whose probe failed or is already running elsewhere
+            job.skipped += 1
+            SCHEDULER_SKIPPED.labels(adapter=job.adapter_id, reason='circuit_open').inc()
+            return
+
+        try:
+            job.fn()
+        except Exception as e:
+            job.failures += 1
+            logger.exception(f'Job {job.name} failed: {e}')
+        finally:
+            if job.peripheral is not None and self.health is not None:
+                self.health.end_trial(job.peripheral)
+            job.runs += 1
+            elapsed = self.clock() - started_at
+            SCHEDULER_RUN_SECONDS.labels(adapter=job.adapter_id).observe(elapsed)
+            if elapsed > job.interval:
+                logger.warning(f'Job {job.name} took {elapsed:.3f}s, longer than its {job.interval}s interval')
+
+    def _finish(self, job: Job):
+        with self._condition:
+            job.running = False
+        SCHEDULER_IN_FLIGHT.labels(adapter=job.adapter_id).dec()
+
+    def run_pending(self) -> Optional[float]:
+        """
+        Dispatches every due job; returns seconds until the next one is due.
+        """
+        with self._condition:
+            now = self.clock()
+            while self._queue:
+                run_at, _, job = self._queue[0]
+                if self.jobs.get(job.name) is not job or run_at != job.next_run_at:
+                    heapq.heappop(self._queue)
+                    continue
+                if run_at > now:
+                    break
+                heapq.heappop(self._queue)
+                self._dispatch(job, now)
+            SCHEDULER_QUEUE_DEPTH.set(len(self._queue))
+            return self._queue[0][0] - now if self._queue else None
+
+    def run_forever(self):
+        while True:
+            wait = self.run_pending()
+            with self._condition:
+                if self._stopped:
+                    return
+                self._condition.wait(wait)
+                if self._stopped:
+                    return
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
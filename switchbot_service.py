@@ -7,6 +7,7 @@ from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoReques
 
 if typing_extensions.TYPE_CHECKING:
     from ble_collector_client import BleCollectorClient
+    from async_ble_collector_client import AsyncBleCollectorClient
 
 
 class Command(enum.Enum):
@@ -36,22 +37,30 @@ class SwitchBotService:
                 service=self.service_uuid,
                 characteristic=self.char_uuid
             ),
-            value=[*cmd.value],
+            value=cmd.value,
             wait_response=False,
             timeout_ms=self.timeout_ms
         )
 
-    def send_request(self):
-        request = PeripheralIoRequestDto(
+    def build_request(self, cmd: Command = Command.PRESS):
+        return PeripheralIoRequestDto(
             batches=[
                 PeripheralIoBatchRequestDto(
-                    commands=[self._build_command(Command.PRESS)],
+                    commands=[self._build_command(cmd)],
                     parallelism=1
                 )
             ],
             parallelism=1
         )
 
-        response = self.client.write_read_peripheral_value(self.adapter_id, request)
+    def send_request(self):
+        response = self.client.write_read_peripheral_value(self.adapter_id, self.build_request())
 
         return response
+
+
+class AsyncSwitchBotService(SwitchBotService):
+    client: 'AsyncBleCollectorClient'
+
+    async def send_request(self):
+        return await self.client.write_read_peripheral_value(self.adapter_id, self.build_request())
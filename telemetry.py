@@ -0,0 +1,211 @@
+import threading
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from bme_calibrator_service import BME280_SERVICE, HUMIDITY_CH, TEMPERATURE_CH, PRESSURE_CH
+from calibration import Quantity, SENSOR_CHARACTERISTICS
+from codec import EncodedIoRequest, encode_batch
+from dto import IoCommand, Fqcn, PeripheralIoBatchRequestDto, PeripheralIoResponseDto
+from health import HealthTracker
+from metrics import BME280_TEMPERATURE, BME280_PRESSURE, BME280_HUMIDITY, BME280_READ_FAILURES
+from notifications import NotificationStream, Subscription, Sample
+from topology import TopologyCache
+from util import deserialize_humidity, deserialize_temperature, deserialize_pressure
+
+GAUGES = {
+    Quantity.HUMIDITY: BME280_HUMIDITY,
+    Quantity.TEMPERATURE: BME280_TEMPERATURE,
+    Quantity.PRESSURE: BME280_PRESSURE,
+}
+
+CHARACTERISTIC_GAUGES = {
+    HUMIDITY_CH: (BME280_HUMIDITY, deserialize_humidity),
+    TEMPERATURE_CH: (BME280_TEMPERATURE, deserialize_temperature),
+    PRESSURE_CH: (BME280_PRESSURE, deserialize_pressure),
+}
+
+
+class Bme280TelemetryReader:
+    """
+    Reads temperature, pressure and humidity of every BME280 peripheral on an adapter with one `/io` request
+    per cycle and publishes them as gauges.
+
+    The encoded request is kept between cycles while the peripheral list stays the same. Peripherals whose
+    circuit is open in `health` are left out, and their gauges removed.
+    """
+
+    def __init__(
+            self, client, timeout_ms: int = 5000, parallelism: int = 32, health: Optional[HealthTracker] = None
+    ):
+        self.client = client
+        self.timeout_ms = timeout_ms
+        self.parallelism = parallelism
+        self.health = health
+        # last request per adapter, with the peripherals it was built for
+        self._requests: dict[str, tuple[tuple[str, ...], EncodedIoRequest]] = {}
+        # peripherals with published gauges, per adapter
+        self._published: dict[str, set[str]] = {}
+
+    def build_request(self, adapter_id: str, peripherals: tuple[str, ...]) -> EncodedIoRequest:
+        cached = self._requests.get(adapter_id)
+        if cached is not None and cached[0] == peripherals:
+            return cached[1]
+
+        batches = [
+            encode_batch(PeripheralIoBatchRequestDto(commands=[
+                IoCommand.read(
+                    fqcn=Fqcn(peripheral=peripheral, service=BME280_SERVICE, characteristic=characteristic),
+                    wait_notification=False,
+                    timeout_ms=self.timeout_ms,
+                )
+                for peripheral in peripherals
+            ], parallelism=self.parallelism))
+            for characteristic, _ in SENSOR_CHARACTERISTICS.values()
+        ]
+        request = EncodedIoRequest(batches, len(batches), peripherals, batch_peripherals=(peripherals,) * len(batches))
+        self._requests[adapter_id] = (peripherals, request)
+        return request
+
+    @staticmethod
+    def decode(response: PeripheralIoResponseDto) -> dict[Quantity, np.ndarray]:
+        values = {}
+        for batch, (quantity, (_, decode)) in zip(response.batch_responses, SENSOR_CHARACTERISTICS.items()):
+            values[quantity] = decode([
+                None if command is None or command.Error is not None else command.Ok
+                for command in batch.command_responses
+            ])
+        return values
+
+    def read(self, adapter_id: str, peripherals: tuple[str, ...]) -> dict[Quantity, np.ndarray]:
+        response = self.client.write_read_peripheral_value(adapter_id, self.build_request(adapter_id, peripherals))
+        return self.decode(response)
+
+    def publish(self, adapter_id: str, peripherals: tuple[str, ...], values: dict[Quantity, np.ndarray]):
+        for quantity, column in values.items():
+            gauge = GAUGES[quantity]
+            failed = np.isnan(column)
+            if failed.any():
+                BME280_READ_FAILURES.labels(quantity=quantity.value).inc(int(failed.sum()))
+            for peripheral, value, is_failed in zip(peripherals, column.tolist(), failed.tolist()):
+                if is_failed:
+                    # don't keep exporting a stale reading
+                    self._remove(gauge, peripheral)
+                else:
+                    gauge.labels(peripheral=peripheral).set(value)
+
+        previous = self._published.get(adapter_id, set())
+        current = self._published[adapter_id] = set(peripherals)
+        for peripheral in previous - current:
+            for gauge in GAUGES.values():
+                self._remove(gauge, peripheral)
+
+    @staticmethod
+    def _remove(gauge, peripheral: str):
+        try:
+            gauge.remove(peripheral)
+        except KeyError:
+            pass
+
+    def poll(self, adapter_id: str, peripherals: list[str]) -> Optional[dict[Quantity, np.ndarray]]:
+        peripherals = tuple(sorted(
+            peripheral for peripheral in peripherals if self.health is None or not self.health.is_open(peripheral)
+        ))
+        if not peripherals:
+            self.publish(adapter_id, peripherals, {})
+            return None
+        values = self.read(adapter_id, peripherals)
+        self.publish(adapter_id, peripherals, values)
+        return values
+
+    def poll_fleet(self, topology: TopologyCache):
+        """
+        Polls every adapter's BME280 peripherals as currently known to the topology cache.
+        """
+        by_adapter: dict[str, list[str]] = {adapter_id: [] for adapter_id in self._published}
+        for peripheral in topology.peripherals_with_service(BME280_SERVICE):
+            adapter_id = topology.adapter_of(peripheral)
+            if adapter_id is not None:
+                by_adapter.setdefault(adapter_id, []).append(peripheral)
+
+        for adapter_id, peripherals in by_adapter.items():
+            try:
+                self.poll(adapter_id, peripherals)
+            except Exception as e:
+                logger.error(f'[{adapter_id}] Failed to read BME280 telemetry: {e}')
+
+
+def bme280_subscriptions(peripheral: str) -> list[Subscription]:
+    return [
+        Subscription(peripheral, BME280_SERVICE, characteristic, decode)
+        for characteristic, (_, decode) in CHARACTERISTIC_GAUGES.items()
+    ]
+
+
+def publish_bme280_sample(sample: Sample):
+    gauge, _ = CHARACTERISTIC_GAUGES[sample.subscription.characteristic]
+    gauge.labels(peripheral=sample.subscription.peripheral).set(sample.value)
+
+
+class Bme280NotificationFollower:
+    """
+    Push-mode alternative to `Bme280TelemetryReader`: keeps a `NotificationStream` per adapter subscribed to every
+    BME280 peripheral of the topology and publishes samples as they arrive. Gauges of peripherals that leave the
+    topology, or whose circuit is open in `health`, are removed.
+
+    Long-polls hold their request open for the whole window, so `client` should not share its admission budget
+    with the polling jobs, and should not coalesce.
+    """
+
+    def __init__(
+            self, client, topology: TopologyCache, window_ms: int = 10000, health: Optional[HealthTracker] = None
+    ):
+        self.client = client
+        self.topology = topology
+        self.window_ms = window_ms
+        self.health = health
+        self.streams: dict[str, NotificationStream] = {}
+        self._peripherals: set[str] = set()
+        self._lock = threading.Lock()
+
+    def publish(self, sample: Sample):
+        with self._lock:
+            # a cycle that started before the peripheral left must not bring its gauges back
+            if sample.subscription.peripheral in self._peripherals:
+                publish_bme280_sample(sample)
+
+    def sync(self):
+        """
+        Updates the subscriptions from the topology; starts a stream thread for adapters seen for the first time.
+        """
+        by_adapter: dict[str, list[Subscription]] = {adapter_id: [] for adapter_id in self.streams}
+        peripherals = set()
+        for peripheral in self.topology.peripherals_with_service(BME280_SERVICE):
+            adapter_id = self.topology.adapter_of(peripheral)
+            if adapter_id is not None and (self.health is None or not self.health.is_open(peripheral)):
+                by_adapter.setdefault(adapter_id, []).extend(bme280_subscriptions(peripheral))
+                peripherals.add(peripheral)
+
+        with self._lock:
+            for peripheral in self._peripherals - peripherals:
+                for gauge, _ in CHARACTERISTIC_GAUGES.values():
+                    Bme280TelemetryReader._remove(gauge, peripheral)
+            self._peripherals = peripherals
+
+        for adapter_id, subscriptions in by_adapter.items():
+            stream = self.streams.get(adapter_id)
+            if stream is None:
+                stream = self.streams[adapter_id] = NotificationStream(
+                    self.client, adapter_id, subscriptions, window_ms=self.window_ms
+                )
+                threading.Thread(
+                    target=stream.run, args=(self.publish,), name=f'notifications-{adapter_id}', daemon=True
+                ).start()
+                logger.info(f'[{adapter_id}] Following BME280 notifications of {len(subscriptions) // 3} peripherals')
+            else:
+                stream.set_subscriptions(subscriptions)
+
+    def stop(self):
+        for stream in self.streams.values():
+            stream.close()
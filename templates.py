@@ -0,0 +1,74 @@
+"""
+Pre-serialized request skeletons for commands that are sent over and over with only the payload changing.
+
+A `BatchTemplate` is compiled once from a batch DTO built with `VALUE_SLOT`/`TIMEOUT_SLOT` placeholders;
+rendering it only encodes the write values and the timeout and joins the cached JSON fragments.
+"""
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Sequence
+
+from codec import encode_batch, encode_value
+from dto import PeripheralIoBatchRequestDto
+
+_VALUE_MARKER = 0x1_0000_0001
+_TIMEOUT_MARKER = 0x1_0000_0002
+_SLOT_RE = re.compile(rf'(\[{_VALUE_MARKER}\]|{_TIMEOUT_MARKER})')
+
+VALUE_SLOT = [_VALUE_MARKER]
+TIMEOUT_SLOT = _TIMEOUT_MARKER
+
+
+class BatchTemplate:
+    __slots__ = ('parts', 'timeout_slots')
+
+    def __init__(self, batch: PeripheralIoBatchRequestDto):
+        tokens = _SLOT_RE.split(encode_batch(batch))
+        self.parts = tokens[::2]
+        self.timeout_slots = [token == str(_TIMEOUT_MARKER) for token in tokens[1::2]]
+
+    def render(self, values: Sequence = (), timeout_ms: int = 0) -> str:
+        """
+        :param values: write values in command order, one per `VALUE_SLOT`
+        """
+        timeout = str(int(timeout_ms))
+        values = iter(values)
+        parts = self.parts
+        out = [parts[0]]
+        for index, is_timeout in enumerate(self.timeout_slots, 1):
+            out.append(timeout if is_timeout else encode_value(next(values)))
+            out.append(parts[index])
+        return ''.join(out)
+
+
+class TemplateCache:
+    """
+    Compiled templates keyed by (peripheral, characteristic, command shape), least recently used first out once
+    there are more than `maxsize`, so peripherals that come and go do not pile up.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._templates: OrderedDict[Hashable, BatchTemplate] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build_batch: Callable[[], PeripheralIoBatchRequestDto]) -> BatchTemplate:
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+        template = BatchTemplate(build_batch())
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def __len__(self):
+        return len(self._templates)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Optional
+
+from loguru import logger
+
+from dto import AdapterDto, Peripheral
+
+
+def _peripheral_services(peripheral: Peripheral) -> dict[str, frozenset[str]]:
+    return {
+        service.uuid: frozenset(characteristic.uuid for characteristic in service.characteristics)
+        for service in peripheral.services
+    }
+
+
+class TopologyCache:
+    """
+    Keeps the last `describe_adapters` result with a TTL and indexes it by peripheral address and service UUID.
+
+    A refresh re-indexes only peripherals whose GATT layout changed, appeared or disappeared.
+    """
+
+    def __init__(self, client, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic):
+        self.client = client
+        self.ttl = ttl
+        self.clock = clock
+        self.adapters: list[AdapterDto] = []
+        self._fetched_at: Optional[float] = None
+        self._lock = threading.RLock()
+
+        self._peripheral_adapter: dict[str, str] = {}
+        self._peripheral_services: dict[str, dict[str, frozenset[str]]] = {}
+        self._service_peripherals: dict[str, set[str]] = defaultdict(set)
+
+    def invalidate(self):
+        with self._lock:
+            self._fetched_at = None
+
+    @property
+    def is_stale(self) -> bool:
+        return self._fetched_at is None or self.clock() - self._fetched_at > self.ttl
+
+    def refresh(self, force: bool = False) -> 'TopologyCache':
+        with self._lock:
+            if force or self.is_stale:
+                self._update(self.client.describe_adapters())
+        return self
+
+    def _update(self, adapters: list[AdapterDto]):
+        seen = set()
+        for adapter in adapters:
+            for peripheral in adapter.peripherals:
+                address = peripheral.address
+                seen.add(address)
+                self._peripheral_adapter[address] = adapter.adapter_info.id
+                services = _peripheral_services(peripheral)
+                if self._peripheral_services.get(address) != services:
+                    self._index(address, services)
+
+        for address in [*self._peripheral_services.keys() - seen]:
+            logger.info(f'Peripheral {address} is gone')
+            self._index(address, None)
+            self._peripheral_adapter.pop(address, None)
+
+        self.adapters = adapters
+        self._fetched_at = self.clock()
+
+    def _index(self, address: str, services: Optional[dict[str, frozenset[str]]]):
+        for service_uuid in self._peripheral_services.pop(address, {}):
+            peripherals = self._service_peripherals[service_uuid]
+            peripherals.discard(address)
+            if not peripherals:
+                del self._service_peripherals[service_uuid]
+        if services is None:
+            return
+        self._peripheral_services[address] = services
+        for service_uuid in services:
+            self._service_peripherals[service_uuid].add(address)
+
+    def peripherals(self) -> list[str]:
+        with self._lock:
+            return [*self.refresh()._peripheral_services]
+
+    def adapter_of(self, address: str) -> Optional[str]:
+        with self._lock:
+            return self.refresh()._peripheral_adapter.get(address)
+
+    def services(self, address: str) -> dict[str, frozenset[str]]:
+        with self._lock:
+            return self.refresh()._peripheral_services.get(address, {})
+
+    def has_service(self, address: str, service_uuid: str) -> bool:
+        return service_uuid in self.services(address)
+
+    def has_characteristic(self, address: str, service_uuid: str, characteristic_uuid: str) -> bool:
+        return characteristic_uuid in self.services(address).get(service_uuid, ())
+
+    def peripherals_with_service(self, service_uuid: str) -> list[str]:
+        with self._lock:
+            return sorted(self.refresh()._service_peripherals.get(service_uuid, ()))
@@ -0,0 +1,159 @@
+"""
+Span hooks around collector round trips, Expander primitives and SCD4X commands.
+
+Tracing is off by default: `span()` hands out a shared no-op context manager until a `Tracer` is installed
+with `set_tracer`. A tracer passes every finished span to its exporters:
+
+    set_tracer(Tracer(JsonLinesExporter(open('trace.jsonl', 'a', buffering=1)), folded := FoldedStackExporter()))
+    ...
+    folded.dump(open('trace.folded', 'w'))     # flamegraph.pl / speedscope input
+"""
+import contextvars
+import json
+import threading
+import time
+from collections import Counter
+from typing import Optional, TextIO, Protocol
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'attrs', 'path', 'started_at', 'wall_started_at', 'duration', 'child_time',
+                 'outcome', 'thread', '_parent', '_token')
+
+    def __init__(self, tracer: 'Tracer', name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.path: tuple[str, ...] = (name,)
+        self.started_at = 0.0
+        self.wall_started_at = 0.0
+        self.duration = 0.0
+        # time spent in nested spans; duration - child_time is the span's own time
+        self.child_time = 0.0
+        self.outcome = 'ok'
+        self.thread = ''
+        self._parent: Optional[Span] = None
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        parent = self._parent = _current_span.get()
+        if parent is not None:
+            self.path = (*parent.path, self.name)
+        self._token = _current_span.set(self)
+        self.thread = threading.current_thread().name
+        self.wall_started_at = time.time()
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.started_at
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.outcome = exc_type.__name__
+        if self._parent is not None:
+            self._parent.child_time += self.duration
+        self.tracer.finish(self)
+        return None
+
+
+class Exporter(Protocol):
+    def export(self, span: Span):
+        ...
+
+
+class Tracer:
+    def __init__(self, *exporters: Exporter):
+        self.exporters = exporters
+
+    def span(self, name: str, attrs: dict) -> Span:
+        return Span(self, name, attrs)
+
+    def finish(self, span: Span):
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+class JsonLinesExporter:
+    """
+    Writes one JSON object per finished span; children are written before their parents.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps({
+            'name': span.name,
+            'path': ';'.join(span.path),
+            'thread': span.thread,
+            'start': round(span.wall_started_at, 6),
+            'duration_ms': round(span.duration * 1000, 3),
+            'self_ms': round((span.duration - span.child_time) * 1000, 3),
+            'outcome': span.outcome,
+            **span.attrs,
+        }, default=str)
+        with self._lock:
+            self.stream.write(line + '\n')
+
+
+class FoldedStackExporter:
+    """
+    Accumulates the own time of every span path in microseconds, in the folded stack format
+    (`root;child;leaf 1234`) that flame graph tools read.
+    """
+
+    def __init__(self):
+        self.stacks: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        self_us = int((span.duration - span.child_time) * 1_000_000)
+        with self._lock:
+            self.stacks[';'.join(span.path)] += max(self_us, 0)
+
+    def dump(self, stream: TextIO):
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        for path, micros in stacks:
+            stream.write(f'{path} {micros}\n')
+
+
+_tracer: Optional[Tracer] = None
+
+
+def set_tracer(tracer: Optional[Tracer]):
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **attrs) -> Span | _NoopSpan:
+    tracer = _tracer
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.span(name, attrs)
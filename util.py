@@ -1,3 +1,4 @@
+import struct
 from dataclasses import dataclass
 from typing import Optional
 
@@ -38,6 +39,66 @@ class Expander:
         self.peripheral_address = peripheral_address
 
 
+# control bits, reserved, lock, power, power_wait, cs, cs_wait, command, address, size_read, size_write, 3x reserved
+DATA_BUNDLE_HEADER = struct.Struct('<BxBBBBBBBHH3x')
+
+
+def _control_bits(lock, power, cs, command, address, mosi) -> int:
+    control_bits = 0
+    if lock is not None:
+        control_bits |= 1 << 7
+    if power is not None:
+        control_bits |= 1 << 6
+    if cs is not None:
+        control_bits |= 1 << 5
+    if command is not None:
+        control_bits |= 1 << 4
+    if address is not None:
+        control_bits |= 1 << 3
+    control_bits |= 1 << 2
+    control_bits |= 1 << 1
+    if mosi is not None:
+        control_bits |= 1 << 0
+    return control_bits
+
+
+def pack_data_bundle_into(
+        buffer: bytearray,
+        lock: Optional[int] = None,
+        power: Optional[bool] = None,
+        cs: Optional[int] = None,
+        command: Optional[int] = None,
+        address: Optional[int] = None,
+        size_read: int = 0,
+        size_write: int = 0,
+        mosi: Optional[bytes] = None,
+        power_wait: int = 0,
+        cs_wait: int = 0,
+) -> int:
+    """
+    Writes a data bundle (see `pack_data_bundle`) at the start of `buffer`, which must be large enough;
+    returns the bundle length.
+    """
+    DATA_BUNDLE_HEADER.pack_into(
+        buffer, 0,
+        _control_bits(lock, power, cs, command, address, mosi),
+        lock or 0,
+        1 if power else 0,
+        power_wait,
+        cs or 0,
+        cs_wait,
+        command or 0,
+        address or 0,
+        (size_read or 0) & 0xFFFF,
+        (size_write or 0) & 0xFFFF,
+    )
+    size = DATA_BUNDLE_HEADER.size
+    if mosi:
+        buffer[size:size + len(mosi)] = mosi
+        size += len(mosi)
+    return size
+
+
 def pack_data_bundle(
         lock: Optional[int] = None,
         power: Optional[bool] = None,
@@ -72,48 +133,11 @@ def pack_data_bundle(
         ..mosi
     ]
     """
-    control_bits = 0
-    if lock is not None:
-        control_bits |= 1 << 7
-    if power is not None:
-        control_bits |= 1 << 6
-    if cs is not None:
-        control_bits |= 1 << 5
-    if command is not None:
-        control_bits |= 1 << 4
-    if address is not None:
-        control_bits |= 1 << 3
-    control_bits |= 1 << 2
-    control_bits |= 1 << 1
-    if mosi is not None:
-        control_bits |= 1 << 0
-
-    data = bytearray(16)
-    data[0] = control_bits
-    if lock is not None:
-        data[2] = lock
-
-    if power is not None:
-        data[3] = 1 if power else 0
-    data[4] = power_wait
-
-    if cs is not None:
-        data[5] = cs
-    data[6] = cs_wait
-
-    if command is not None:
-        data[7] = command
-    if address is not None:
-        data[8] = address
-    if size_read is not None:
-        data[9] = size_read & 0xFF
-        data[10] = (size_read >> 8) & 0xFF
-    if size_write is not None:
-        data[11] = size_write & 0xFF
-        data[12] = (size_write >> 8) & 0xFF
-    if mosi is not None:
-        data[16:] = mosi
-
+    data = bytearray(DATA_BUNDLE_HEADER.size + (len(mosi) if mosi else 0))
+    pack_data_bundle_into(
+        data, lock=lock, power=power, cs=cs, command=command, address=address, size_read=size_read,
+        size_write=size_write, mosi=mosi, power_wait=power_wait, cs_wait=cs_wait,
+    )
     return data
 
 
@@ -147,6 +171,5 @@ def deserialize_humidity(data: bytearray):
 
 
 def deserialize_float(data: bytearray):
-    import struct
     value = struct.unpack('f', data)
     return value[0]